@@ -0,0 +1,34 @@
+import csv
+import os
+from typing import Dict, List
+
+from sqlalchemy import text
+
+# размер пачки серверного курсора, если COPY недоступен
+EXPORT_FETCH_ROWS = 2000
+
+def export_query_to_csv(session, sql: str, params: Dict, file_path: str, header: List[str]) -> str:
+    """
+    Потоковая выгрузка результата sql в CSV (utf-8-sig, разделитель ';', строка заголовка), память O(1).
+    psycopg2: COPY (sql) TO STDOUT прямо в файл; иначе — серверный курсор с yield_per.
+    NULL выгружается пустым полем; значения форматируются в самом SQL.
+    """
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    stmt = text(sql).bindparams(**params)
+    conn = session.connection()
+    with open(file_path, "w", encoding="utf-8-sig", newline="") as f:
+        csv.writer(f, delimiter=';', lineterminator="\n").writerow(header)
+        if conn.dialect.driver == "psycopg2":
+            compiled = stmt.compile(dialect=conn.dialect)
+            cur = conn.connection.cursor()
+            try:
+                copy_sql = cur.mogrify(f"COPY ({compiled}) TO STDOUT WITH (FORMAT csv, DELIMITER ';')", compiled.params)
+                f.flush()
+                cur.copy_expert(copy_sql, f)
+            finally:
+                cur.close()
+        else:
+            w = csv.writer(f, delimiter=';', lineterminator="\n")
+            for row in session.execute(stmt.execution_options(yield_per=EXPORT_FETCH_ROWS)):
+                w.writerow(row)
+    return file_path
@@ -1,5 +1,137 @@
-from app.db.database import engine
-from app.db.models import Base
+from sqlalchemy import text
 
-def init_db():
-    Base.metadata.create_all(bind=engine)
+from app.db.database import engine, prewarm_pool
+from app.db.models import Base, STATS_SLOTS
+from app.db.partitioning import (HISTORY_PARTITIONING, PARTITIONED_TABLES, table_kind,
+                                 create_partitioned_table, ensure_future_partitions)
+
+# ключ advisory-lock, чтобы одновременно стартующие рабочие места не гоняли DDL параллельно
+_INIT_LOCK_KEY = 7_301_001
+
+# агрегаты task_items по (shift_id, slot) из transition-таблицы rows, со знаком sign;
+# закрытые смены не учитываются: их строки уходят в архив, итоги — в shift_summaries
+def _stats_delta_sql(rows: str, sign: str) -> str:
+    return f"""
+        INSERT INTO shift_stats AS st (shift_id, slot, total_copies, remaining_copies, item_count, completed_count)
+        SELECT d.shift_id, d.id % {STATS_SLOTS}, {sign}SUM(d.total_copies), {sign}SUM(d.remaining_copies),
+               {sign}COUNT(*), {sign}COUNT(*) FILTER (WHERE d.remaining_copies <= 0)
+        FROM {rows} d
+        WHERE EXISTS (SELECT 1 FROM shifts s WHERE s.id = d.shift_id AND s.status = 'open')
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (shift_id, slot) DO UPDATE SET
+            total_copies = st.total_copies + EXCLUDED.total_copies,
+            remaining_copies = st.remaining_copies + EXCLUDED.remaining_copies,
+            item_count = st.item_count + EXCLUDED.item_count,
+            completed_count = st.completed_count + EXCLUDED.completed_count"""
+
+# UPDATE: разность new_rows - old_rows по id (shift_id позиции не меняется); строки, где итоговые колонки
+# не изменились (например, только reserved_copies у аренды), shift_stats не трогают
+def _stats_update_sql() -> str:
+    return f"""
+        INSERT INTO shift_stats AS st (shift_id, slot, total_copies, remaining_copies, item_count, completed_count)
+        SELECT n.shift_id, n.id % {STATS_SLOTS}, SUM(n.total_copies - o.total_copies),
+               SUM(n.remaining_copies - o.remaining_copies), 0,
+               SUM((n.remaining_copies <= 0)::int - (o.remaining_copies <= 0)::int)
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.total_copies, n.remaining_copies) IS DISTINCT FROM (o.total_copies, o.remaining_copies)
+          AND EXISTS (SELECT 1 FROM shifts s WHERE s.id = n.shift_id AND s.status = 'open')
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (shift_id, slot) DO UPDATE SET
+            total_copies = st.total_copies + EXCLUDED.total_copies,
+            remaining_copies = st.remaining_copies + EXCLUDED.remaining_copies,
+            completed_count = st.completed_count + EXCLUDED.completed_count"""
+
+# DDL, которого create_all не делает: новые колонки существующих таблиц, функции и триггеры.
+# Всё идемпотентно и выполняется при каждом старте.
+UPGRADE_DDL = [
+    "ALTER TABLE task_items ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT txid_current()",
+    "ALTER TABLE collector_history ADD COLUMN IF NOT EXISTS op_id varchar(36)",
+    "ALTER TABLE check_history ADD COLUMN IF NOT EXISTS op_id varchar(36)",
+    "ALTER TABLE shifts ADD COLUMN IF NOT EXISTS archived_at timestamptz",
+    "ALTER TABLE task_items ADD COLUMN IF NOT EXISTS reserved_copies int NOT NULL DEFAULT 0",
+    # очередь сборки учитывает аренды: прежние частичные индексы (remaining_copies > 0) заменены ix_taskitem_free_*
+    "DROP INDEX IF EXISTS ix_taskitem_avail_id",
+    "DROP INDEX IF EXISTS ix_taskitem_avail_largest",
+    """
+    CREATE OR REPLACE FUNCTION task_items_bump_version() RETURNS trigger AS $$
+    BEGIN
+        NEW.version := txid_current();
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION task_items_tombstone() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO task_item_tombstones (shift_id, article_id, version)
+        SELECT o.shift_id, o.article_id, txid_current() FROM old_rows o
+        WHERE EXISTS (SELECT 1 FROM shifts s WHERE s.id = o.shift_id AND s.status = 'open');
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_task_items_version') THEN
+            CREATE TRIGGER trg_task_items_version BEFORE UPDATE ON task_items
+            FOR EACH ROW EXECUTE FUNCTION task_items_bump_version();
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_task_items_tombstone') THEN
+            CREATE TRIGGER trg_task_items_tombstone AFTER DELETE ON task_items
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION task_items_tombstone();
+        END IF;
+    END $$
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION task_items_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            {_stats_update_sql()};
+        ELSIF TG_OP = 'DELETE' THEN
+            {_stats_delta_sql("old_rows", "-")};
+        ELSE
+            {_stats_delta_sql("new_rows", "")};
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    # триггеры и первичное заполнение shift_stats — в одной транзакции: CREATE TRIGGER блокирует запись в task_items
+    f"""
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_task_items_stats_ins') THEN
+            CREATE TRIGGER trg_task_items_stats_ins AFTER INSERT ON task_items
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_items_stats();
+            CREATE TRIGGER trg_task_items_stats_upd AFTER UPDATE ON task_items
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_items_stats();
+            CREATE TRIGGER trg_task_items_stats_del AFTER DELETE ON task_items
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION task_items_stats();
+            DELETE FROM shift_stats;
+            {_stats_delta_sql("task_items", "")};
+        END IF;
+    END $$
+    """,
+]
+
+def init_db(log=print):
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _INIT_LOCK_KEY})
+        conn.execute(text("SET LOCAL statement_timeout = 0"))  # DDL/бэкфилл не ограничиваем DB_STATEMENT_TIMEOUT_MS
+        if HISTORY_PARTITIONING:
+            # историю создаём партиционированной до create_all (тот пропускает существующие таблицы)
+            Base.metadata.create_all(bind=conn, tables=[t for name, t in Base.metadata.tables.items()
+                                                        if name not in PARTITIONED_TABLES])
+            for table in PARTITIONED_TABLES:
+                if table_kind(conn, table) is None:
+                    create_partitioned_table(conn, table)
+        Base.metadata.create_all(bind=conn)
+        for ddl in UPGRADE_DDL:
+            conn.execute(text(ddl))
+        ensure_future_partitions(conn, log=log)
+    # create_all не трогает существующие таблицы — досоздаём индексы, добавленные позже
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        for table in Base.metadata.sorted_tables:
+            for idx in table.indexes:
+                idx.create(bind=conn, checkfirst=True)
+    prewarm_pool()
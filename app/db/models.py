@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, BigInteger, Integer, String, Text, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, BigInteger, Integer, SmallInteger, String, Text, DateTime, ForeignKey, UniqueConstraint, Index, text
 from sqlalchemy import func
 from sqlalchemy.dialects.postgresql import JSONB
 
@@ -32,7 +32,47 @@ class Shift(Base):
     started_by_role = Column(String(50), nullable=True)
     started_by_computer = Column(String(255), nullable=True)
     status = Column(String(20), nullable=False, default="open", index=True)
+    archived_at = Column(DateTime(timezone=True))  # строки смены перенесены в *_archive
     task_items = relationship("TaskItem", back_populates="shift", cascade="all, delete-orphan")
+    __table_args__ = (
+        # поиск открытой смены (OPEN_SHIFT) не зависит от числа закрытых
+        Index("ix_shifts_open_started", "started_at", postgresql_where=text("status = 'open'")),
+    )
+
+class ShiftSummary(Base):
+    """
+    Итоги закрытой смены (пишет TaskRepository.close_shift).
+    per_article: {code: [total, remaining]}, per_collector: {collector: copies}, per_inspector: {inspector: checks}.
+    """
+    __tablename__ = "shift_summaries"
+    shift_id = Column(BigInteger, ForeignKey("shifts.id", ondelete="CASCADE"), primary_key=True)
+    closed_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    closed_by = Column(String(255), nullable=True)
+    total_copies = Column(BigInteger, nullable=False, default=0)
+    remaining_copies = Column(BigInteger, nullable=False, default=0)
+    item_count = Column(BigInteger, nullable=False, default=0)
+    completed_count = Column(BigInteger, nullable=False, default=0)
+    collected_copies = Column(BigInteger, nullable=False, default=0)
+    check_count = Column(BigInteger, nullable=False, default=0)
+    per_article = Column(JSONB, nullable=False, default=dict)
+    per_collector = Column(JSONB, nullable=False, default=dict)
+    per_inspector = Column(JSONB, nullable=False, default=dict)
+
+# на сколько строк разложены агрегаты одной смены в shift_stats (slot = task_items.id % STATS_SLOTS)
+STATS_SLOTS = 16
+
+class ShiftStats(Base):
+    """
+    Агрегаты смены, поддерживаемые триггерами task_items (см. init_db). Разложены на STATS_SLOTS строк,
+    чтобы параллельные сборки не упирались в одну строку; итог смены — SUM по её слотам.
+    """
+    __tablename__ = "shift_stats"
+    shift_id = Column(BigInteger, ForeignKey("shifts.id", ondelete="CASCADE"), primary_key=True)
+    slot = Column(SmallInteger, primary_key=True)
+    total_copies = Column(BigInteger, nullable=False, default=0)
+    remaining_copies = Column(BigInteger, nullable=False, default=0)
+    item_count = Column(BigInteger, nullable=False, default=0)
+    completed_count = Column(BigInteger, nullable=False, default=0)
 
 class TaskItem(Base):
     __tablename__ = "task_items"
@@ -41,9 +81,45 @@ class TaskItem(Base):
     article_id = Column(BigInteger, ForeignKey("articles.id", ondelete="RESTRICT"), nullable=False, index=True)
     total_copies = Column(Integer, nullable=False)
     remaining_copies = Column(Integer, nullable=False)
+    # копии под действующими арендами (TaskLease): уже выданы на печать, но ещё не подтверждены
+    reserved_copies = Column(Integer, nullable=False, server_default=text("0"))
+    # txid последней записавшей транзакции (ставит триггер, см. init_db) — для дельта-синхронизации
+    version = Column(BigInteger, nullable=False, server_default=text("txid_current()"))
     shift = relationship("Shift", back_populates="task_items")
     article = relationship("Article")
-    __table_args__ = (UniqueConstraint("shift_id", "article_id", name="uq_taskitem_shift_article"),)
+    __table_args__ = (
+        UniqueConstraint("shift_id", "article_id", name="uq_taskitem_shift_article"),
+        # очередь доступных позиций для task_picker (предикат = task_picker.AVAILABLE)
+        Index("ix_taskitem_free_id", "shift_id", "id", postgresql_where=text("remaining_copies > reserved_copies")),
+        Index("ix_taskitem_free_largest", "shift_id", remaining_copies.desc(), "id",
+              postgresql_where=text("remaining_copies > reserved_copies")),
+        # очередь шарда для ShardDispatcher (выражение = task_picker.IN_SHARD, 16 = TASK_SHARDS)
+        Index("ix_taskitem_free_shard", "shift_id", text("(id % 16)"), "id",
+              postgresql_where=text("remaining_copies > reserved_copies")),
+        Index("ix_taskitem_shift_version", "shift_id", "version"),
+    )
+
+class TaskLease(Base):
+    """
+    Аренда одной копии позиции на время печати (TaskRepository.reserve): подтверждение списывает копию
+    вместе с записью истории, отказ или истечение срока (sweep_expired_leases) только снимает резерв.
+    """
+    __tablename__ = "task_leases"
+    id = Column(BigInteger, primary_key=True)
+    task_item_id = Column(BigInteger, ForeignKey("task_items.id", ondelete="CASCADE"), nullable=False, index=True)
+    collector = Column(String(255), nullable=False)
+    op_id = Column(String(36), nullable=False, unique=True)  # клиентский id: повтор reserve вернёт ту же аренду
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class TaskItemTombstone(Base):
+    """Удалённые позиции задания (пишет триггер на DELETE), чтобы get_task_changes отдавал и удаления."""
+    __tablename__ = "task_item_tombstones"
+    id = Column(BigInteger, primary_key=True)
+    shift_id = Column(BigInteger, ForeignKey("shifts.id", ondelete="CASCADE"), nullable=False)
+    article_id = Column(BigInteger, nullable=False)
+    version = Column(BigInteger, nullable=False, server_default=text("txid_current()"))
+    __table_args__ = (Index("ix_tombstone_shift_version", "shift_id", "version"),)
 
 class CollectorHistory(Base):
     __tablename__ = "collector_history"
@@ -53,8 +129,16 @@ class CollectorHistory(Base):
     collector = Column(String(255), nullable=False)
     occurred_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     copies = Column(Integer, nullable=False, default=1)
+    # клиентский id события (журнал рабочего места): повторная отправка не создаёт дубль
+    op_id = Column(String(36), nullable=True)
     shift = relationship("Shift")
     article = relationship("Article")
+    __table_args__ = (
+        Index("ix_collector_history_shift_id_id", "shift_id", "id"),  # keyset-страницы
+        Index("ix_collector_history_occurred_brin", "occurred_at", postgresql_using="brin"),  # выгрузки по датам
+        # occurred_at входит в ключ: уникальный индекс партиционированной таблицы обязан содержать ключ партиции
+        Index("ux_collector_history_op_id", "op_id", "occurred_at", unique=True),
+    )
 
 class CheckHistory(Base):
     __tablename__ = "check_history"
@@ -63,5 +147,58 @@ class CheckHistory(Base):
     article_id = Column(BigInteger, ForeignKey("articles.id", ondelete="SET NULL"), index=True)
     inspector = Column(String(255), nullable=False)
     occurred_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    op_id = Column(String(36), nullable=True)
     shift = relationship("Shift")
     article = relationship("Article")
+    __table_args__ = (
+        Index("ix_check_history_shift_id_id", "shift_id", "id"),
+        Index("ix_check_history_occurred_brin", "occurred_at", postgresql_using="brin"),
+        Index("ux_check_history_op_id", "op_id", "occurred_at", unique=True),
+    )
+
+# результаты операций с клиентским op_id (отмена и т.п.): повтор с тем же op_id возвращает сохранённое, а не выполняется снова
+class OperationLog(Base):
+    __tablename__ = "operation_log"
+    op_id = Column(String(36), primary_key=True)
+    kind = Column(String(32), nullable=False)
+    result = Column(JSONB)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    __table_args__ = (Index("ix_operation_log_created_at", "created_at"),)
+
+# --- архив закрытых смен: те же колонки без внешних ключей, строки переносит TaskRepository.archive_shift ---
+class TaskItemArchive(Base):
+    __tablename__ = "task_items_archive"
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    shift_id = Column(BigInteger, nullable=False)
+    article_id = Column(BigInteger, nullable=False)
+    total_copies = Column(Integer, nullable=False)
+    remaining_copies = Column(Integer, nullable=False)
+    version = Column(BigInteger, nullable=False)
+    __table_args__ = (Index("ix_task_items_archive_shift_id", "shift_id", "id"),)
+
+class CollectorHistoryArchive(Base):
+    __tablename__ = "collector_history_archive"
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    shift_id = Column(BigInteger)
+    article_id = Column(BigInteger)
+    collector = Column(String(255), nullable=False)
+    occurred_at = Column(DateTime(timezone=True), nullable=False)
+    copies = Column(Integer, nullable=False)
+    op_id = Column(String(36), nullable=True)
+    __table_args__ = (
+        Index("ix_collector_history_archive_shift_id", "shift_id", "id"),
+        Index("ix_collector_history_archive_occurred_brin", "occurred_at", postgresql_using="brin"),
+    )
+
+class CheckHistoryArchive(Base):
+    __tablename__ = "check_history_archive"
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    shift_id = Column(BigInteger)
+    article_id = Column(BigInteger)
+    inspector = Column(String(255), nullable=False)
+    occurred_at = Column(DateTime(timezone=True), nullable=False)
+    op_id = Column(String(36), nullable=True)
+    __table_args__ = (
+        Index("ix_check_history_archive_shift_id", "shift_id", "id"),
+        Index("ix_check_history_archive_occurred_brin", "occurred_at", postgresql_using="brin"),
+    )
@@ -0,0 +1,112 @@
+"""
+Помесячное RANGE-партиционирование collector_history / check_history по occurred_at.
+
+Включается HISTORY_PARTITIONING=1: init_db создаёт новые таблицы истории партиционированными и
+при каждом старте досоздаёт партиции на months_ahead месяцев вперёд. Существующие таблицы
+переводятся скриптом scripts/partition_history.py (migrate_to_partitioned).
+"""
+
+import os
+from datetime import date
+from typing import Iterable
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+
+from app.db.models import Base
+
+HISTORY_PARTITIONING = os.getenv("HISTORY_PARTITIONING", "0") == "1"
+PARTITIONED_TABLES = ("collector_history", "check_history")
+PARTITION_MONTHS_AHEAD = int(os.getenv("HISTORY_PARTITION_MONTHS_AHEAD", "2"))
+
+def _add_months(d: date, n: int) -> date:
+    y, m = divmod(d.month - 1 + n, 12)
+    return date(d.year + y, m + 1, 1)
+
+def _month_starts(first: date, last: date) -> Iterable[date]:
+    d = date(first.year, first.month, 1)
+    while d <= last:
+        yield d
+        d = _add_months(d, 1)
+
+def table_kind(conn, table: str) -> str | None:
+    """'p' — партиционированная, 'r' — обычная, None — таблицы нет."""
+    return conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"), {"t": table}).scalar()
+
+def create_partitioned_table(conn, table: str) -> None:
+    """DDL модели + PRIMARY KEY (id, occurred_at) + PARTITION BY RANGE; ключ партиции обязан входить в PK."""
+    ddl = str(CreateTable(Base.metadata.tables[table]).compile(dialect=conn.dialect)).strip()
+    ddl = ddl.replace("PRIMARY KEY (id)", "PRIMARY KEY (id, occurred_at)")
+    conn.execute(text(f"{ddl} PARTITION BY RANGE (occurred_at)"))
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+
+def ensure_partitions(conn, table: str, first: date, last: date) -> None:
+    """Партиции {table}_yYYYYmMM на каждый месяц [first, last]."""
+    for start in _month_starts(first, last):
+        end = _add_months(start, 1)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {table}_y{start:%Y}m{start:%m} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+
+def ensure_future_partitions(conn, months_ahead: int = PARTITION_MONTHS_AHEAD, log=print) -> None:
+    today = date.today()
+    for table in PARTITIONED_TABLES:
+        if table_kind(conn, table) != "p":
+            continue
+        try:
+            with conn.begin_nested():
+                ensure_partitions(conn, table, today, _add_months(today, months_ahead))
+        except Exception as e:
+            # например, в DEFAULT-партиции уже лежат строки этого месяца — не мешаем старту приложения
+            log(f"Не удалось создать партиции {table}: {e}")
+
+def migrate_to_partitioned(engine, table: str, batch_rows: int = 50000, keep_legacy: bool = False, log=print) -> None:
+    """
+    Перевод обычной таблицы истории в партиционированную: переименование в {table}_legacy,
+    создание новой таблицы с партициями на весь диапазон данных (последовательность id продолжается
+    с max(id) старой таблицы), перенос пачками по id. Запускать вне смены.
+    """
+    legacy = f"{table}_legacy"
+    with engine.begin() as conn:
+        if table_kind(conn, table) != "r":
+            log(f"{table}: уже партиционирована или отсутствует — пропуск")
+            return
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        # имена индексов уникальны в схеме — освобождаем их для новой таблицы
+        for (idx,) in conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :t"), {"t": legacy}).all():
+            conn.execute(text(f'ALTER INDEX "{idx}" RENAME TO "{idx}_legacy"'))
+        lo, hi = conn.execute(text(f"SELECT min(occurred_at), max(occurred_at) FROM {legacy}")).one()
+        create_partitioned_table(conn, table)
+        today = date.today()
+        ensure_partitions(conn, table, (lo.date() if lo else today), _add_months(max(hi.date() if hi else today, today), PARTITION_MONTHS_AHEAD))
+        for idx in Base.metadata.tables[table].indexes:
+            idx.create(bind=conn, checkfirst=True)
+        # новые записи (если приложение уже пишет) не должны получить id, занятые переносимыми строками
+        conn.execute(text(f"""
+            SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(max(id), 0) + 1 FROM {legacy}), false)
+        """))
+
+    cols = ", ".join(c.name for c in Base.metadata.tables[table].columns)
+    last_id, moved = 0, 0
+    while True:
+        with engine.begin() as conn:
+            conn.execute(text("SET LOCAL statement_timeout = 0"))
+            n, top = conn.execute(text(f"""
+                WITH b AS (
+                    INSERT INTO {table} ({cols})
+                    SELECT {cols} FROM {legacy} WHERE id > :last ORDER BY id LIMIT :n
+                    RETURNING id
+                ) SELECT count(*), max(id) FROM b
+            """), {"last": last_id, "n": batch_rows}).one()
+        if not n:
+            break
+        last_id, moved = top, moved + n
+        log(f"{table}: перенесено {moved}")
+
+    if not keep_legacy:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE {legacy}"))
+    log(f"{table}: готово, строк {moved}")
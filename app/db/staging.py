@@ -0,0 +1,38 @@
+import csv
+import io
+from typing import Iterable, Sequence
+
+from sqlalchemy import text
+
+# сколько строк буферизуем в памяти перед очередным COPY
+COPY_CHUNK_ROWS = 5000
+
+def create_staging_table(session, name: str, columns_ddl: str) -> None:
+    """Временная таблица в текущей транзакции; удаляется при COMMIT/ROLLBACK."""
+    session.execute(text(f"CREATE TEMP TABLE {name} ({columns_ddl}) ON COMMIT DROP"))
+
+def copy_into(session, table: str, columns: Sequence[str], rows: Iterable[Sequence], chunk_rows: int = COPY_CHUNK_ROWS) -> int:
+    """
+    Потоковая заливка rows в table через COPY FROM STDIN (psycopg2) пачками по chunk_rows.
+    None и пустая строка уходят как NULL. Возвращает число залитых строк.
+    """
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    cur = session.connection().connection.cursor()
+    total = 0
+    try:
+        buf = io.StringIO()
+        w = csv.writer(buf, lineterminator="\n")
+        pending = 0
+        for row in rows:
+            w.writerow(row)
+            pending += 1
+            if pending >= chunk_rows:
+                buf.seek(0); cur.copy_expert(sql, buf)
+                total += pending; pending = 0
+                buf.seek(0); buf.truncate()
+        if pending:
+            buf.seek(0); cur.copy_expert(sql, buf)
+            total += pending
+    finally:
+        cur.close()
+    return total
@@ -0,0 +1,103 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.db.models import Article
+
+# ключ в session.info: id, увиденные в ещё не закоммиченной транзакции
+_PENDING_KEY = "article_ids_pending"
+
+class ArticleIdCache:
+    """
+    Потокобезопасный ограниченный LRU-кэш code -> id, общий для всех репозиториев процесса.
+    Артикулы не удаляются (FK RESTRICT), поэтому закоммиченный id никогда не устаревает.
+    """
+
+    def __init__(self, maxsize: int = 50000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, codes: Iterable[str]) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        with self._lock:
+            for code in codes:
+                aid = self._data.get(code)
+                if aid is None:
+                    self.misses += 1
+                    continue
+                self._data.move_to_end(code)
+                out[code] = aid
+                self.hits += 1
+        return out
+
+    def put_many(self, mapping: Dict[str, int]) -> None:
+        if not mapping:
+            return
+        with self._lock:
+            for code, aid in mapping.items():
+                self._data[code] = aid
+                self._data.move_to_end(code)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+ARTICLE_CACHE = ArticleIdCache(int(os.getenv("ARTICLE_CACHE_SIZE", "50000")))
+
+def remember_article_ids(session, mapping: Dict[str, int]) -> None:
+    """Запомнить code -> id; в общий кэш попадут только после COMMIT этой сессии."""
+    if mapping:
+        session.info.setdefault(_PENDING_KEY, {}).update(mapping)
+
+def resolve_article_ids(session, codes: Iterable[str], batch_size: int = 1000) -> Dict[str, int]:
+    """
+    code -> id для пачки артикулов: сначала кэш, затем для промахов один INSERT ... ON CONFLICT DO NOTHING
+    RETURNING и один SELECT на пачку. Если тот же код параллельно создаёт другое рабочее место,
+    ON CONFLICT дождётся его транзакции, и SELECT вернёт уже закоммиченную строку.
+    """
+    codes = list(dict.fromkeys(codes))
+    found = ARTICLE_CACHE.get_many(codes)
+    pending = session.info.get(_PENDING_KEY, {})
+    missing = []
+    for code in codes:
+        if code in found:
+            continue
+        if code in pending:
+            found[code] = pending[code]
+        else:
+            missing.append(code)
+
+    for i in range(0, len(missing), batch_size):
+        chunk = missing[i:i + batch_size]
+        fresh = dict(session.execute(
+            pg_insert(Article).values([{"code": c} for c in chunk])
+            .on_conflict_do_nothing(index_elements=[Article.code])
+            .returning(Article.code, Article.id)
+        ).all())
+        rest = [c for c in chunk if c not in fresh]
+        if rest:
+            fresh.update(session.execute(select(Article.code, Article.id).where(Article.code.in_(rest))).all())
+        remember_article_ids(session, fresh)
+        found.update(fresh)
+    return found
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending(session):
+    ARTICLE_CACHE.put_many(session.info.pop(_PENDING_KEY, None) or {})
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session):
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,50 @@
+"""
+Быстрый путь чтения для горячих запросов: Core-select только нужных колонок через Connection,
+без ORM-сущностей, identity map и инструментирования атрибутов. Возвращает Row — компактный
+именованный кортеж (row.code, row[0], распаковка).
+
+Выражения собраны один раз на уровне модуля: SQLAlchemy кэширует их компиляцию
+(query_cache_size у engine), параметры передаются через bindparam.
+"""
+
+from typing import Sequence
+
+from sqlalchemy import select, bindparam
+from sqlalchemy.engine import Row
+
+from app.db.models import Article, TaskItem, CollectorHistory, CheckHistory
+
+_a = Article.__table__
+_ti = TaskItem.__table__
+_ch = CollectorHistory.__table__
+_kh = CheckHistory.__table__
+
+# (code, article_id, total_copies, remaining_copies) в порядке добавления в задание
+TASK_ROWS = (
+    select(_a.c.code, _ti.c.article_id, _ti.c.total_copies, _ti.c.remaining_copies)
+    .select_from(_ti.join(_a, _a.c.id == _ti.c.article_id))
+    .where(_ti.c.shift_id == bindparam("shift_id"))
+    .order_by(_ti.c.id)
+)
+
+def _history_rows(table, *cols):
+    return (
+        select(table.c.id, _a.c.code, *cols, table.c.occurred_at)
+        .select_from(table.outerjoin(_a, _a.c.id == table.c.article_id))
+        .where(table.c.shift_id == bindparam("shift_id"))
+        .order_by(table.c.id)
+    )
+
+# (id, code, collector, copies, occurred_at) / (id, code, inspector, occurred_at) по возрастанию id
+COLLECT_ROWS = _history_rows(_ch, _ch.c.collector, _ch.c.copies)
+CHECK_ROWS = _history_rows(_kh, _kh.c.inspector)
+
+# session.connection() — Connection текущей транзакции сессии: выполнение минуя ORM-слой Session.execute
+def task_rows(session, shift_id: int) -> Sequence[Row]:
+    return session.connection().execute(TASK_ROWS, {"shift_id": shift_id}).all()
+
+def collect_rows(session, shift_id: int) -> Sequence[Row]:
+    return session.connection().execute(COLLECT_ROWS, {"shift_id": shift_id}).all()
+
+def check_rows(session, shift_id: int) -> Sequence[Row]:
+    return session.connection().execute(CHECK_ROWS, {"shift_id": shift_id}).all()
@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+from app.services.repositories import HistoryRepository
+from app.services.history_writer import HISTORY_KINDS, send_history_events, stamp_event
+
+JOURNAL_FILE = "history_journal.sqlite3"
+
+# ошибки связи с БД: пачку оставляем в журнале и повторяем позже; прочие ошибки — «битое» событие
+_RETRYABLE = (OperationalError, InterfaceError)
+
+class HistoryJournal:
+    """
+    Локальный журнал событий истории (SQLite в temp_save_dir рабочего места).
+
+    append() пишет событие на локальный диск (synchronous=FULL) и сразу возвращает управление;
+    фоновый поток отправляет события в PostgreSQL пачками в порядке записи и удаляет отправленные.
+    После падения процесса неотправленные события уходят при следующем старте. Повторная отправка
+    безопасна: у каждого события свой op_id (уникален в истории вместе с occurred_at).
+    События, которые БД отвергает не из-за связи, переносятся в таблицу failed, чтобы не блокировать очередь.
+    """
+
+    def __init__(self, directory: str, repo: Optional[HistoryRepository] = None, batch_size: int = 500,
+                 flush_interval_s: float = 0.5, max_backoff_s: float = 30.0, log: Callable[[str], None] = print):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, JOURNAL_FILE)
+        self.repo = repo or HistoryRepository()
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.max_backoff_s = max_backoff_s
+        self.log = log
+        self.last_error: Optional[Exception] = None
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS failed (seq INTEGER PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, error TEXT)")
+        self._db_lock = threading.Lock()     # sqlite-соединение общее для потоков
+        self._flush_lock = threading.Lock()  # отправка — строго по одной, иначе порядок не гарантирован
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="history-journal", daemon=True)
+        self._thread.start()
+
+    # --- запись ---
+    def append(self, kind: str, event: dict) -> str:
+        """Записать событие ('collect' | 'check') в журнал; возвращает его op_id."""
+        if kind not in HISTORY_KINDS:
+            raise ValueError(f"kind must be one of {HISTORY_KINDS}")
+        ev = stamp_event(event)
+        at = ev["occurred_at"]
+        ev["occurred_at"] = at.isoformat() if isinstance(at, datetime) else at
+        with self._db_lock:
+            self._db.execute("INSERT INTO events (kind, payload) VALUES (?, ?)", (kind, json.dumps(ev, ensure_ascii=False)))
+        self._wake.set()
+        return ev["op_id"]
+
+    def pending(self) -> int:
+        with self._db_lock:
+            return self._db.execute("SELECT count(*) FROM events").fetchone()[0]
+
+    # --- отправка ---
+    def flush(self) -> int:
+        """Отправить всё накопленное в вызывающем потоке. Исключение — БД недоступна (события остаются в журнале)."""
+        sent = 0
+        with self._flush_lock:
+            while True:
+                with self._db_lock:
+                    rows = self._db.execute("SELECT seq, kind, payload FROM events ORDER BY seq LIMIT ?",
+                                            (self.batch_size,)).fetchall()
+                if not rows:
+                    return sent
+                try:
+                    self._send(rows)
+                except _RETRYABLE:
+                    raise
+                except Exception:
+                    self._send_one_by_one(rows)
+                with self._db_lock:
+                    self._db.execute("DELETE FROM events WHERE seq <= ?", (rows[-1][0],))
+                sent += len(rows)
+
+    def _send(self, rows) -> None:
+        send_history_events(self.repo, [(kind, json.loads(payload)) for _, kind, payload in rows])
+
+    def _send_one_by_one(self, rows) -> None:
+        for row in rows:
+            try:
+                self._send([row])
+            except _RETRYABLE:
+                raise
+            except Exception as e:
+                self.log(f"Журнал истории: событие {row[0]} отклонено БД и отложено в failed: {e}")
+                with self._db_lock:
+                    self._db.execute("INSERT OR REPLACE INTO failed (seq, kind, payload, error) VALUES (?, ?, ?, ?)",
+                                     (row[0], row[1], row[2], str(e)))
+
+    def _run(self) -> None:
+        backoff = 0.0
+        while not self._stop.is_set():
+            if backoff:
+                self._stop.wait(backoff)  # БД недоступна: новые события не торопят повтор
+            else:
+                self._wake.wait(self.flush_interval_s)
+            self._wake.clear()
+            try:
+                self.flush()
+                if self.last_error is not None:
+                    self.log("Журнал истории: связь с БД восстановлена, очередь отправлена")
+                backoff, self.last_error = 0.0, None
+            except Exception as e:
+                if self.last_error is None:
+                    self.log(f"Журнал истории: БД недоступна, события копятся локально ({e})")
+                self.last_error = e
+                backoff = min(self.max_backoff_s, max(1.0, backoff * 2))
+
+    def close(self, timeout: float = 5.0) -> int:
+        """Остановить поток и попытаться отправить остаток; возвращает число неотправленных событий."""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        try:
+            self.flush()
+        except Exception as e:
+            self.log(f"Журнал истории: остаток будет отправлен при следующем запуске ({e})")
+        left = self.pending()
+        with self._db_lock:
+            self._db.close()
+        return left
@@ -1,33 +1,99 @@
-from typing import List, Dict
-from app.services.repositories import HistoryRepository
+import uuid
+from typing import List, Dict, Optional
+from app.db.database import retry_idempotent
+from app.services.repositories import HistoryRepository, HISTORY_PAGE_SIZE
+from app.services.history_journal import HistoryJournal
+from app.services.history_writer import CoalescingHistoryWriter, send_history_events, stamp_event
+from app.services.shift_cache import OPEN_SHIFT
 
 class HistoryServiceDB:
     """Истории в PostgreSQL; имена методов сохранены для совместимости с UI."""
 
     def __init__(self):
         self.repo = HistoryRepository()
+        # отложенная запись: HistoryJournal (на диск) или CoalescingHistoryWriter (в памяти); None — сразу в БД
+        self.writer: Optional[HistoryJournal | CoalescingHistoryWriter] = None
+
+    # --- отложенная запись ---
+    def enable_journal(self, directory: str, log=print) -> HistoryJournal:
+        """Писать события через локальный журнал (см. HistoryJournal) вместо синхронных INSERT."""
+        if self.writer is None:
+            self.writer = HistoryJournal(directory, self.repo, log=log)
+        return self.writer
+
+    def enable_coalescing(self, max_events: int = 200, max_delay_s: float = 0.5, log=print) -> CoalescingHistoryWriter:
+        """Копить события в памяти и писать пачками (см. CoalescingHistoryWriter)."""
+        if self.writer is None:
+            self.writer = CoalescingHistoryWriter(self.repo, max_events=max_events, max_delay_s=max_delay_s, log=log)
+        return self.writer
+
+    def _save(self, kind: str, events: List[Dict]) -> None:
+        if self.writer is None:
+            # одна транзакция на вызов; у событий op_id — повтор после обрыва не создаст дублей
+            items = [(kind, stamp_event(ev)) for ev in events]
+            retry_idempotent(lambda: send_history_events(self.repo, items), f"svc.add_{kind}")
+            return
+        # смену фиксируем в момент события без запроса к БД (журнал должен принимать сканы и при её недоступности):
+        # при отправке позже открытой может быть уже другая. None — процесс ещё не видел смены, её определит отправка
+        shift_id = OPEN_SHIFT.last_known()
+        for ev in events:
+            self.writer.append(kind, {**ev, "shift_id": shift_id})
+
+    def _flush_quietly(self) -> None:
+        if self.writer is not None:
+            try:
+                self.writer.flush()
+            except Exception:
+                pass
+
+    def _flush(self) -> None:
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
     # --- Collector ---
     def save_collector_data(self, path: str, data: List[Dict], append: bool = True) -> str:
-        for row in data:
-            self.repo.add_collect(article_code=row.get("article",""), collector=row.get("collector",""), copies=int(row.get("copies",1)))
+        self._save("collect", [{"article": row.get("article",""), "collector": row.get("collector",""),
+                                "copies": int(row.get("copies",1))} for row in data])
         return path
 
     def load_collector_data(self, path: str) -> List[Dict]:
+        self._flush_quietly()
         return self.repo.get_collect()
 
+    def load_collector_page(self, before_id: int | None = None, limit: int = HISTORY_PAGE_SIZE) -> List[Dict]:
+        """Страница (новые -> старые) до before_id; для отображения по возрастанию развернуть."""
+        if before_id is None:
+            self._flush_quietly()  # первая страница должна включать ещё не записанные события
+        return self.repo.get_collect_page(before_id, limit, newest_first=True)
+
+    def load_collector_tail(self, since_id: int) -> List[Dict]:
+        return self.repo.get_collect_tail(since_id)
+
     def clear_collector_file(self, path: str) -> None:
         pass
 
     # --- Check ---
     def save_check_history(self, path: str, data: List[Dict], append: bool = True) -> str:
-        for row in data:
-            self.repo.add_check(article_code=row.get("article",""), inspector=row.get("inspector",""))
+        self._save("check", [{"article": row.get("article",""), "inspector": row.get("inspector","")} for row in data])
         return path
 
     def load_check_history(self, path: str) -> List[Dict]:
+        self._flush_quietly()
         return self.repo.get_check()
 
+    def load_check_page(self, before_id: int | None = None, limit: int = HISTORY_PAGE_SIZE) -> List[Dict]:
+        if before_id is None:
+            self._flush_quietly()
+        return self.repo.get_check_page(before_id, limit, newest_first=True)
+
+    def load_check_tail(self, since_id: int) -> List[Dict]:
+        return self.repo.get_check_tail(since_id)
+
     def clear_check_history_file(self, path: str) -> None:
         pass
 
@@ -41,9 +107,14 @@ class HistoryServiceDB:
     def save_temp(self, temp_dir: str, collectors: List[Dict], checks: List[Dict]) -> None:
         pass
 
-    # Cancel
-    def cancel_last_collect(self) -> Dict | None:
-        return self.repo.cancel_last_collect()
+    # Cancel: сначала дописываем отложенные события, иначе отменится не последнее;
+    # op_id на вызов — повтор после обрыва не отменит ещё одну запись
+    def cancel_last_collect(self, restore_remaining: bool = False) -> Dict | None:
+        self._flush()
+        op_id = str(uuid.uuid4())
+        return retry_idempotent(lambda: self.repo.cancel_last_collect(op_id, restore_remaining), "svc.cancel_collect")
 
     def cancel_last_check(self) -> Dict | None:
-        return self.repo.cancel_last_check()
+        self._flush()
+        op_id = str(uuid.uuid4())
+        return retry_idempotent(lambda: self.repo.cancel_last_check(op_id), "svc.cancel_check")
@@ -0,0 +1,119 @@
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from app.services.repositories import HistoryRepository
+
+HISTORY_KINDS = ("collect", "check")
+
+def send_history_events(repo: HistoryRepository, items: Iterable[Tuple[str, dict]]) -> int:
+    """
+    Отправить события (kind, event) в порядке следования: подряд идущие события одного вида —
+    один многострочный INSERT в одной транзакции. Возвращает число вставленных строк.
+    """
+    senders = {"collect": repo.add_collect_many, "check": repo.add_check_many}
+    inserted = 0
+    for kind, group in itertools.groupby(items, key=lambda it: it[0]):
+        inserted += senders[kind]([ev for _, ev in group])
+    return inserted
+
+def stamp_event(event: dict) -> dict:
+    """op_id и время события фиксируются при постановке в очередь — повторная отправка идемпотентна."""
+    ev = dict(event)
+    ev.setdefault("op_id", str(uuid.uuid4()))
+    ev.setdefault("occurred_at", datetime.utcnow())
+    return ev
+
+class CoalescingHistoryWriter:
+    """
+    Буфер событий истории в памяти: пачка уходит в БД одной транзакцией, когда набралось max_events
+    или прошло max_delay_s с первого события пачки. Всплеск сканирования — несколько COMMIT вместо
+    одного на событие. Падение процесса буфер не переживает (для этого HistoryJournal).
+    """
+
+    def __init__(self, repo: Optional[HistoryRepository] = None, max_events: int = 200, max_delay_s: float = 0.5,
+                 max_backoff_s: float = 30.0, log: Callable[[str], None] = print):
+        self.repo = repo or HistoryRepository()
+        self.max_events = max_events
+        self.max_delay_s = max_delay_s
+        self.max_backoff_s = max_backoff_s
+        self.log = log
+        self.last_error: Optional[Exception] = None
+        self._buf: List[Tuple[str, dict]] = []
+        self._first_at = 0.0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, kind: str, event: dict) -> str:
+        if kind not in HISTORY_KINDS:
+            raise ValueError(f"kind must be one of {HISTORY_KINDS}")
+        ev = stamp_event(event)
+        with self._cond:
+            first = not self._buf
+            if first:
+                self._first_at = time.monotonic()
+            self._buf.append((kind, ev))
+            # первое событие пачки взводит в _run таймер max_delay_s, полная пачка — уходит сразу
+            if first or len(self._buf) >= self.max_events:
+                self._cond.notify()
+        return ev["op_id"]
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._buf)
+
+    def flush(self) -> int:
+        """Отправить буфер в вызывающем потоке; при ошибке события возвращаются в начало буфера."""
+        with self._flush_lock:
+            with self._cond:
+                items, self._buf = self._buf, []
+            if not items:
+                return 0
+            try:
+                return send_history_events(self.repo, items)
+            except Exception:
+                with self._cond:
+                    self._buf[:0] = items
+                    self._first_at = time.monotonic()
+                raise
+
+    def _run(self) -> None:
+        backoff = 0.0
+        while True:
+            with self._cond:
+                while not self._stop:
+                    if self._buf:
+                        wait = self._first_at + max(self.max_delay_s, backoff) - time.monotonic()
+                        if len(self._buf) >= self.max_events and not backoff or wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._stop:
+                    return
+            try:
+                self.flush()
+                backoff, self.last_error = 0.0, None
+            except Exception as e:
+                if self.last_error is None:
+                    self.log(f"Запись истории: ошибка БД, повтор ({e})")
+                self.last_error = e
+                backoff = min(self.max_backoff_s, max(1.0, backoff * 2))
+
+    def close(self, timeout: float = 5.0) -> int:
+        """Остановить поток и отправить остаток; возвращает число неотправленных (потерянных) событий."""
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        try:
+            self.flush()
+        except Exception as e:
+            self.log(f"Запись истории: {self.pending()} событий не записано в БД ({e})")
+        return self.pending()
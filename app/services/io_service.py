@@ -1,6 +1,47 @@
+import csv
+import itertools
 import chardet
 import pandas as pd
-from typing import List, Dict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+# строк в одной пачке потокового разбора CSV: память не зависит от размера файла
+CSV_CHUNK_ROWS = 5000
+
+ARTICLE_KEYS = ('артикул', 'article', 'код', 'code')
+COPIES_KEYS = ('количество', 'кол-во', 'copies', 'count', 'quantity')
+
+def to_int(value, default: Optional[int] = 1) -> Optional[int]:
+    """'3', '3.0', ' 3 ' -> 3; пусто или мусор -> default."""
+    try:
+        return int(float(str(value).strip()))
+    except (TypeError, ValueError):
+        return default
+
+def _article_row(rec: Dict[str, str]) -> Dict[str, int]:
+    return {"article": rec["article"], "copies": to_int(rec.get("copies"))}
+
+class CsvRows:
+    """
+    Строки CSV для импорта без загрузки файла в память: каждый обход заново читает файл пачками
+    по chunk_rows (IOService.iter_csv_chunks). Повторно итерируем — транзакцию импорта можно повторить.
+    """
+
+    def __init__(self, io: "IOService", file_path: str, fields: Dict[str, Sequence[str]],
+                 convert: Callable[[Dict[str, str]], Optional[dict]], chunk_rows: int = CSV_CHUNK_ROWS):
+        self.io, self.file_path, self.fields, self.convert, self.chunk_rows = io, file_path, fields, convert, chunk_rows
+        self.encoding = io.detect_csv_encoding(file_path)
+        self.delimiter = io.detect_csv_delimiter(file_path, self.encoding)
+
+    def chunks(self) -> Iterator[List[dict]]:
+        return self.io.iter_csv_chunks(self.file_path, self.fields, self.convert, self.chunk_rows,
+                                       encoding=self.encoding, delimiter=self.delimiter)
+
+    def empty(self) -> bool:
+        """Нет ни одной строки с артикулом (пустой файл, только заголовок)."""
+        return next(self.io.iter_csv_records(self.file_path, self.fields, self.encoding, self.delimiter), None) is None
+
+    def __iter__(self) -> Iterator[dict]:
+        return itertools.chain.from_iterable(self.chunks())
 
 class IOService:
     """Загрузка списков артикулов из Excel/CSV/TXT."""
@@ -66,46 +107,62 @@ class IOService:
             data.append({"article": art, "copies": copies})
         return data
 
-    def load_csv(self, file_path: str) -> List[Dict[str, int]]:
-        enc = self.detect_csv_encoding(file_path)
-        delim = self.detect_csv_delimiter(file_path, enc)
+    # --- потоковый CSV ---
+    def iter_csv_records(self, file_path: str, fields: Dict[str, Sequence[str]], encoding: Optional[str] = None,
+                         delimiter: Optional[str] = None) -> Iterator[Dict[str, str]]:
+        """
+        Записи CSV по одной через csv.reader (кавычки, разделитель и перевод строки внутри поля):
+        {поле: значение без пробелов по краям, "" — нет колонки/значения}. Колонка поля — первая, в заголовке
+        которой есть одна из подстрок fields[поле]; первое поле fields (артикул) без совпадения — колонка 0.
+        Записи с пустым первым полем пропускаются.
+        """
+        enc = encoding or self.detect_csv_encoding(file_path)
+        delim = delimiter or self.detect_csv_delimiter(file_path, enc)
         with open(file_path, 'r', encoding=enc, newline='') as f:
-            content = f.read().splitlines()
-        if not content:
-            return []
-        headers = content[0].split(delim)
-        article_idx, copies_idx = -1, -1
-        for i, h in enumerate(headers):
-            hcl = str(h).strip().lower()
-            if any(k in hcl for k in ['артикул', 'article', 'код', 'code']):
-                article_idx = i
-            elif any(k in hcl for k in ['количество', 'кол-во', 'copies', 'count', 'quantity']):
-                copies_idx = i
-        if article_idx == -1:
-            article_idx = 0
-
-        data = []
-        for ln in content[1:]:
-            if not ln.strip():
-                continue
-            row = ln.split(delim)
-            if len(row) <= article_idx:
-                continue
-            art = str(row[article_idx]).strip()
-            if not art:
+            reader = csv.reader(f, delimiter=delim)
+            header = next(reader, None)
+            if header is None:
+                return
+            header = [h.strip().lower() for h in header]
+            idx = {name: next((i for i, h in enumerate(header) if any(k in h for k in keys)), None)
+                   for name, keys in fields.items()}
+            key = next(iter(fields))
+            if idx[key] is None:
+                idx[key] = 0
+            for r in reader:
+                rec = {name: (r[i].strip() if i is not None and i < len(r) else "") for name, i in idx.items()}
+                if rec[key]:
+                    yield rec
+
+    def iter_csv_chunks(self, file_path: str, fields: Dict[str, Sequence[str]],
+                        convert: Callable[[Dict[str, str]], Optional[dict]], chunk_rows: int = CSV_CHUNK_ROWS,
+                        encoding: Optional[str] = None, delimiter: Optional[str] = None) -> Iterator[List[dict]]:
+        """Пачки по chunk_rows строк convert(запись) (None — строка отбрасывается), см. iter_csv_records."""
+        chunk: List[dict] = []
+        for rec in self.iter_csv_records(file_path, fields, encoding, delimiter):
+            row = convert(rec)
+            if row is None:
                 continue
-            copies = 1
-            if copies_idx != -1 and len(row) > copies_idx:
-                try:
-                    copies = int(float(str(row[copies_idx]).strip()))
-                except Exception:
-                    copies = 1
-            data.append({"article": art, "copies": copies})
-        return data
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
-    def load_text(self, file_path: str) -> List[Dict[str, int]]:
+    def csv_rows(self, file_path: str, fields: Dict[str, Sequence[str]],
+                 convert: Callable[[Dict[str, str]], Optional[dict]], chunk_rows: int = CSV_CHUNK_ROWS) -> CsvRows:
+        return CsvRows(self, file_path, fields, convert, chunk_rows)
+
+    def iter_csv(self, file_path: str) -> Iterator[Dict[str, int]]:
+        """Артикулы {article, copies} из CSV потоком."""
+        return iter(self.csv_rows(file_path, {"article": ARTICLE_KEYS, "copies": COPIES_KEYS}, _article_row))
+
+    def load_csv(self, file_path: str) -> List[Dict[str, int]]:
+        return list(self.iter_csv(file_path))
+
+    def iter_text(self, file_path: str) -> Iterator[Dict[str, int]]:
         enc = self.detect_csv_encoding(file_path)
-        out: List[Dict[str, int]] = []
         with open(file_path, 'r', encoding=enc) as f:
             for line in f:
                 ln = line.strip()
@@ -113,7 +170,7 @@ class IOService:
                     continue
                 parts = ln.split()
                 if len(parts) == 1:
-                    out.append({"article": parts[0], "copies": 1})
+                    yield {"article": parts[0], "copies": 1}
                 else:
                     try:
                         copies = int(float(parts[-1]))
@@ -121,8 +178,20 @@ class IOService:
                     except Exception:
                         copies = 1
                         art = ln
-                    out.append({"article": art, "copies": copies})
-        return out
+                    yield {"article": art, "copies": copies}
+
+    def load_text(self, file_path: str) -> List[Dict[str, int]]:
+        return list(self.iter_text(file_path))
+
+    def iter_any(self, file_path: str) -> Iterable[Dict[str, int]]:
+        """Как load_any, но CSV/TXT читаются потоком (Excel pandas всё равно грузит целиком)."""
+        low = file_path.lower()
+        if low.endswith(('.xlsx', '.xls')):
+            return self.load_excel(file_path)
+        elif low.endswith('.csv'):
+            return self.iter_csv(file_path)
+        else:
+            return self.iter_text(file_path)
 
     def load_any(self, file_path: str) -> List[Dict[str, int]]:
         low = file_path.lower()
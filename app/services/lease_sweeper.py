@@ -0,0 +1,46 @@
+import threading
+from typing import Callable, Optional
+
+from app.services.repositories import TaskRepository, LEASE_SWEEP_BATCH
+
+class LeaseSweeper:
+    """
+    Фоновый поток: раз в interval_s снимает истёкшие аренды (рабочее место упало посреди печати)
+    пачками по batch. Может работать на каждом рабочем месте — в БД убирает только один (advisory-lock).
+    """
+
+    def __init__(self, repo: Optional[TaskRepository] = None, interval_s: float = 30.0, batch: int = LEASE_SWEEP_BATCH,
+                 log: Callable[[str], None] = print):
+        self.repo = repo or TaskRepository()
+        self.interval_s = interval_s
+        self.batch = batch
+        self.log = log
+        self.last_error: Optional[Exception] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-sweeper", daemon=True)
+        self._thread.start()
+
+    def sweep(self) -> int:
+        """Снять все истёкшие аренды; возвращает их число."""
+        total = 0
+        while True:
+            n = self.repo.sweep_expired_leases(self.batch)
+            total += n
+            if n < self.batch:
+                return total
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            try:
+                n = self.sweep()
+                if n:
+                    self.log(f"Сняты истёкшие аренды позиций: {n}")
+                self.last_error = None
+            except Exception as e:
+                if self.last_error is None:
+                    self.log(f"Уборка аренд: ошибка БД ({e})")
+                self.last_error = e
+
+    def close(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._thread.join(timeout)
@@ -1,26 +1,236 @@
+import itertools
+import uuid
 from datetime import datetime
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Iterable, Callable
 
-from sqlalchemy import select, update, func, delete
-from sqlalchemy.orm import joinedload
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy import select, update, func, delete, literal_column, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import NoResultFound, IntegrityError
 
-from app.db.database import session_scope, session_scope_serializable, advisory_xact_lock
-from app.db.models import Settings, Article, Shift, TaskItem, CollectorHistory, CheckHistory
+from app.db.database import (session_scope, read_session_scope, run_in_transaction, set_local_statement_timeout,
+                             advisory_xact_lock, advisory_xact_lock_shared, advisory_xact_lock_slots, LOCK_SLOTS)
+from app.db.staging import create_staging_table, copy_into
+from app.db.csv_export import export_query_to_csv
+from app.services.article_cache import resolve_article_ids, remember_article_ids
+from app.services.shift_cache import OPEN_SHIFT, notify_shift_changed
+from app.services.task_picker import pick_task_item_id, first_pick, fill_picks, start_sql
+from app.services.fast_reads import task_rows, collect_rows, check_rows
+from app.db.models import (Settings, Article, Shift, TaskItem, CollectorHistory, CheckHistory, ShiftStats, STATS_SLOTS,
+                           ShiftSummary, TaskItemArchive, CollectorHistoryArchive, CheckHistoryArchive, OperationLog)
 from app.core.constants import SUPPORTED_PRINTER_EXTS, DEFAULT_CANCEL_PASSWORD
 
+# размер пачки для set-based INSERT ... ON CONFLICT (ограничивает число bind-параметров в одном запросе)
+BULK_BATCH_SIZE = 1000
+
 # --- helpers ---
-def _get_or_create_article(session, code: str) -> Article:
-    a = session.execute(select(Article).where(Article.code == code)).scalar_one_or_none()
-    if not a:
-        a = Article(code=code); session.add(a); session.flush()
-    return a
-
-def _get_open_shift(session, create_if_absent: bool = True) -> Shift:
-    sh = session.execute(select(Shift).where(Shift.status == "open").order_by(Shift.started_at.desc())).scalars().first()
-    if sh is None and create_if_absent:
-        sh = Shift(status="open"); session.add(sh); session.flush()
-    return sh
+def _batched(items: list, size: int = BULK_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _chunks(items: Iterable, size: int = BULK_BATCH_SIZE):
+    """Как _batched, но для любого итерируемого: вход не материализуется целиком."""
+    it = iter(items)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+def _task_snapshot(session, shift_id: int, remember: bool = True) -> Tuple[List[Dict[str,int]], Dict[str,int]]:
+    rows = task_rows(session, shift_id)
+    if remember:
+        remember_article_ids(session, {code: aid for code, aid, _, _ in rows})
+    articles = [{"article": code, "copies": total} for code, _, total, _ in rows]
+    remaining = {code: left for code, _, _, left in rows}
+    return articles, remaining
+
+# --- строки для staging-импорта (нормализация та же, что была в построчном импорте) ---
+def _task_staging_rows(rows: Iterable[dict]):
+    for r in rows:
+        code = str(r["article"]).strip()
+        if not code:
+            continue
+        total = int(r.get("total") or r.get("copies") or 1)
+        remaining = r.get("remaining")
+        yield code, total, (total if remaining is None else int(remaining))
+
+def _collect_staging_rows(rows: Iterable[dict]):
+    for r in rows:
+        code = str(r.get("article","")).strip()
+        if not code:
+            continue
+        yield code, r.get("collector",""), r.get("datetime"), int(r.get("copies", 1) or 1)
+
+def _check_staging_rows(rows: Iterable[dict]):
+    for r in rows:
+        code = str(r.get("article","")).strip()
+        if not code:
+            continue
+        yield code, r.get("inspector",""), r.get("datetime")
+
+def _history_batch(session, model, events: Iterable[dict], fields: Dict[str, Callable[[dict], object]]) -> int:
+    """
+    Пачка событий истории одним многострочным INSERT на BULK_BATCH_SIZE строк, в порядке events
+    (id растут в том же порядке). fields: колонка -> извлечение значения из события.
+    Событие с уже записанным (op_id, occurred_at) пропускается — повторная отправка идемпотентна.
+    Возвращает число реально вставленных строк.
+    """
+    events = [e for e in events if str(e.get("article", "")).strip()]
+    if not events:
+        return 0
+    art_ids = resolve_article_ids(session, [str(e["article"]).strip() for e in events])
+    # событие без смены и без открытой смены пишется с shift_id NULL — не в смену, открытую позже
+    open_sh = _open_shift_id(session) if any(e.get("shift_id") is None for e in events) else None
+    rows = []
+    for e in events:
+        at = e.get("occurred_at") or datetime.utcnow()
+        row = {"shift_id": e.get("shift_id") or open_sh, "article_id": art_ids[str(e["article"]).strip()],
+               "occurred_at": datetime.fromisoformat(at) if isinstance(at, str) else at, "op_id": e.get("op_id")}
+        row.update({col: get(e) for col, get in fields.items()})
+        rows.append(row)
+    inserted = 0
+    for chunk in _batched(rows):
+        inserted += len(session.execute(
+            pg_insert(model).values(chunk)
+            .on_conflict_do_nothing(index_elements=[model.op_id, model.occurred_at])
+            .returning(model.id)
+        ).all())
+    return inserted
+
+def _article_id(session, code: str) -> int:
+    return resolve_article_ids(session, [code])[code]
+
+def _open_shift_id(session, create_if_absent: bool = False) -> Optional[int]:
+    """
+    id открытой смены из кэша процесса (сбрасывается по NOTIFY от start_new_shift); None — смена закрыта.
+    Новую смену открывает только start_new_shift: иначе закрытие на одном рабочем месте отменило бы
+    первое же обновление/скан на другом.
+    """
+    return OPEN_SHIFT.get(session, create_if_absent=create_if_absent)
+
+def _require_open_shift(session) -> int:
+    """Для записи в задание/историю: без открытой смены — NoResultFound."""
+    sh_id = _open_shift_id(session)
+    if sh_id is None:
+        raise NoResultFound("No open shift")
+    return sh_id
+
+def _read_shift_id(shift_id: Optional[int] = None) -> Optional[int]:
+    """
+    Смена для read_session_scope: id из кэша (при промахе — с primary), вызывать до открытия читающей сессии.
+    На реплике смену не создать, и новая смена могла ещё не доехать.
+    """
+    if shift_id:
+        return shift_id
+    with session_scope() as s:
+        return _open_shift_id(s, create_if_absent=False)
+
+def _import_lock(session, shift_id: int, staging: str, fine_locks: bool, whole_shift: bool = False) -> None:
+    """
+    Блокировки импорта в смену. fine_locks: shared-lock смены (эксклюзивный берёт только replace) +
+    advisory-слоты артикулов из staging (article_id % LOCK_SLOTS) — импорты с непересекающимися
+    артикулами идут параллельно, сборка вообще не ждёт. Иначе — прежний эксклюзивный lock всей смены.
+    """
+    if not fine_locks or whole_shift:
+        advisory_xact_lock(session, shift_id)
+        return
+    advisory_xact_lock_shared(session, shift_id)
+    advisory_xact_lock_slots(session, shift_id, f"""
+        SELECT DISTINCT (a.id % :slots)::int AS slot FROM {staging} g JOIN articles a ON a.code = g.code
+    """, {"slots": LOCK_SLOTS})
+
+def _run_import(work: Callable, rows: Iterable[dict], name: str, fine_locks: bool):
+    """
+    Импорт через run_in_transaction: fine_locks — READ COMMITTED, иначе SERIALIZABLE.
+    Повтор после 40001/40P01 заново читает rows, поэтому возможен только для повторно итерируемых
+    rows (список, CsvRows — перечитывает файл); итератор/генератор отдаётся одной попыткой.
+    """
+    return run_in_transaction(work, name=name, isolation=None if fine_locks else "SERIALIZABLE",
+                              retries=None if iter(rows) is not rows else 0)
+
+# --- операции рабочего места с клиентским op_id ---
+# сколько дней хранить operation_log (чистится при закрытии смены); повторы приходят за секунды
+OPERATION_LOG_KEEP_DAYS = 7
+
+def _run_op(work: Callable, name: str, op_id: Optional[str]):
+    """
+    Короткая операция рабочего места: run_in_transaction с OP_STATEMENT_TIMEOUT_MS.
+    Уникальный ключ по op_id упал (23505) — параллельная попытка той же операции успела закоммитить;
+    транзакция повторяется один раз и возвращает уже записанный результат.
+    """
+    def timed(s):
+        set_local_statement_timeout(s)
+        return work(s)
+    try:
+        return run_in_transaction(timed, name=name)
+    except IntegrityError as e:
+        if op_id is None or getattr(e.orig, "pgcode", None) != "23505":
+            raise
+        return run_in_transaction(timed, name=name)
+
+def _once(session, op_id: Optional[str], kind: str, apply: Callable):
+    """apply(session) не более одного раза на op_id: результат (JSON) сохраняется в operation_log в той же транзакции."""
+    if op_id is None:
+        return apply(session)
+    hit = session.execute(select(OperationLog.result).where(OperationLog.op_id == op_id)).first()
+    if hit is not None:
+        return hit[0]
+    result = apply(session)
+    session.execute(pg_insert(OperationLog).values(op_id=op_id, kind=kind, result=result))
+    return result
+
+# --- аренды позиций (reserve -> печать -> confirm_lease | release_lease) ---
+# срок аренды по умолчанию: печать одного комплекта укладывается с запасом; потом копию снимет sweep_expired_leases
+LEASE_TTL_S = 120
+LEASE_SWEEP_BATCH = 1000
+# ключ advisory-lock уборщика: со всех рабочих мест одновременно убирает только один
+_LEASE_SWEEP_LOCK_KEY = 7_301_002
+
+# --- закрытие и архив смен ---
+# строк за одну транзакцию переноса в архив: блокировки короткие, работа открытой смены не стопорится
+ARCHIVE_BATCH_ROWS = 5000
+
+# горячая таблица -> архивная модель (переносятся колонки архивной модели); выгрузки читают обе (_with_archive)
+_ARCHIVE_TABLES = (
+    ("task_items", TaskItemArchive),
+    ("collector_history", CollectorHistoryArchive),
+    ("check_history", CheckHistoryArchive),
+)
+
+def _with_archive(table: str, archive: str, cols: str) -> str:
+    """Подзапрос: горячая таблица и её архив; фильтры внешнего WHERE PostgreSQL проталкивает в обе ветки."""
+    return f"(SELECT {cols} FROM {table} UNION ALL SELECT {cols} FROM {archive})"
+
+_SUMMARY_SQL = """
+    INSERT INTO shift_summaries (shift_id, closed_by, total_copies, remaining_copies, item_count, completed_count,
+                                 collected_copies, check_count, per_article, per_collector, per_inspector)
+    SELECT :sh, :by, t.total, t.remaining, t.items, t.completed, c.copies, k.checks,
+           t.per_article, c.per_collector, k.per_inspector
+    FROM (
+        SELECT COALESCE(SUM(ti.total_copies), 0) AS total, COALESCE(SUM(ti.remaining_copies), 0) AS remaining,
+               COUNT(*) AS items, COUNT(*) FILTER (WHERE ti.remaining_copies <= 0) AS completed,
+               COALESCE(jsonb_object_agg(a.code, jsonb_build_array(ti.total_copies, ti.remaining_copies)), '{}'::jsonb) AS per_article
+        FROM task_items ti JOIN articles a ON a.id = ti.article_id
+        WHERE ti.shift_id = :sh
+    ) t, (
+        SELECT COALESCE(SUM(n), 0) AS copies, COALESCE(jsonb_object_agg(collector, n), '{}'::jsonb) AS per_collector
+        FROM (SELECT collector, SUM(copies) AS n FROM collector_history WHERE shift_id = :sh GROUP BY collector) x
+    ) c, (
+        SELECT COALESCE(SUM(n), 0) AS checks, COALESCE(jsonb_object_agg(inspector, n), '{}'::jsonb) AS per_inspector
+        FROM (SELECT inspector, COUNT(*) AS n FROM check_history WHERE shift_id = :sh GROUP BY inspector) x
+    ) k
+    ON CONFLICT (shift_id) DO NOTHING
+"""
+
+def _close_shift(session, shift_id: int, closed_by: Optional[str] = None) -> bool:
+    """status='closed', ended_at и итоги в shift_summaries в текущей транзакции; False — смена уже не открыта."""
+    closed = session.execute(
+        update(Shift).where(Shift.id == shift_id, Shift.status == "open")
+        .values(status="closed", ended_at=func.now()).returning(Shift.id)
+    ).scalar()
+    if closed is None:
+        return False
+    session.execute(text(_SUMMARY_SQL), {"sh": shift_id, "by": closed_by})
+    session.execute(text("DELETE FROM operation_log WHERE created_at < now() - make_interval(days => :d)"),
+                    {"d": OPERATION_LOG_KEEP_DAYS})
+    return True
 
 # --- Settings ---
 class SettingsRepository:
@@ -63,6 +273,9 @@ class SettingsRepository:
 class TaskRepository:
     def start_new_shift(self, started_by_role=None, started_by_computer=None):
         with session_scope() as s:
+            # прежние открытые смены закрываем с итогами; их строки переносит в архив archive_closed_shifts
+            for (old_id,) in s.execute(select(Shift.id).where(Shift.status == "open")).all():
+                _close_shift(s, old_id, closed_by=started_by_computer)
             shift = Shift(
                 status="open",
                 started_at=datetime.now(),
@@ -75,49 +288,168 @@ class TaskRepository:
 
             s.add(shift)
             s.flush()
-            return shift.id
+            shift_id = shift.id
+            notify_shift_changed(s, shift_id)  # остальные рабочие места сбросят кэш смены после COMMIT
+        OPEN_SHIFT.invalidate()
+        return shift_id
 
     def continue_open_shift(self) -> Optional[int]:
         with session_scope() as s:
-            sh = _get_open_shift(s, create_if_absent=False)
-            return sh.id if sh else None
+            return _open_shift_id(s, create_if_absent=False)
+
+    def close_shift(self, shift_id: Optional[int] = None, closed_by: Optional[str] = None, archive: bool = False) -> Optional[Dict]:
+        """
+        Закрыть смену (по умолчанию — текущую открытую): итоги в shift_summaries, status='closed', ended_at;
+        остальные рабочие места получают NOTIFY. archive=True — затем перенос её строк в архив.
+        -> итоги смены (get_shift_summary) или None, если открытой смены нет.
+        """
+        with session_scope() as s:
+            sh_id = shift_id or _open_shift_id(s, create_if_absent=False)
+            if sh_id is None:
+                return None
+            if _close_shift(s, sh_id, closed_by):
+                notify_shift_changed(s, sh_id)
+        OPEN_SHIFT.invalidate()
+        if archive:
+            self.archive_shift(sh_id)
+        return self.get_shift_summary(sh_id, max_lag_s=0)  # только что записанные итоги — с primary
+
+    def get_shift_summary(self, shift_id: int, max_lag_s: Optional[float] = None) -> Optional[Dict]:
+        with read_session_scope(max_lag_s) as s:
+            row = s.get(ShiftSummary, shift_id)
+            if row is None:
+                return None
+            return {c.name: getattr(row, c.name) for c in ShiftSummary.__table__.columns}
+
+    def archive_shift(self, shift_id: int, batch_rows: int = ARCHIVE_BATCH_ROWS) -> Dict[str, int]:
+        """
+        Перенос задания и историй закрытой смены в *_archive пачками по batch_rows (каждая — своя транзакция,
+        DELETE ... RETURNING -> INSERT), затем очистка shift_stats и надгробий. Повторный запуск продолжает с места сбоя.
+        -> {таблица: перенесено строк}
+        """
+        with session_scope() as s:
+            status = s.execute(select(Shift.status).where(Shift.id == shift_id)).scalar()
+        if status is None:
+            raise NoResultFound(f"Shift {shift_id} not found")
+        if status == "open":
+            raise ValueError(f"Shift {shift_id} is open; close it before archiving")
+
+        moved: Dict[str, int] = {}
+        for table, model in _ARCHIVE_TABLES:
+            cols = ", ".join(c.name for c in model.__table__.columns)
+            moved[table] = 0
+            while True:
+                with session_scope() as s:
+                    n = s.execute(text(f"""
+                        WITH batch AS (
+                            DELETE FROM {table} WHERE id IN (
+                                SELECT id FROM {table} WHERE shift_id = :sh ORDER BY id LIMIT :n
+                            ) RETURNING {cols}
+                        )
+                        INSERT INTO {model.__tablename__} ({cols}) SELECT {cols} FROM batch
+                    """), {"sh": shift_id, "n": batch_rows}).rowcount
+                moved[table] += n
+                if n < batch_rows:
+                    break
+
+        with session_scope() as s:
+            s.execute(delete(ShiftStats).where(ShiftStats.shift_id == shift_id))
+            s.execute(text("DELETE FROM task_item_tombstones WHERE shift_id = :sh"), {"sh": shift_id})
+            s.execute(update(Shift).where(Shift.id == shift_id).values(archived_at=func.now()))
+        return moved
+
+    def archive_closed_shifts(self, batch_rows: int = ARCHIVE_BATCH_ROWS) -> Dict[int, Dict[str, int]]:
+        """Архивировать все закрытые, но ещё не перенесённые смены. -> {shift_id: {таблица: строк}}"""
+        with session_scope() as s:
+            ids = s.execute(select(Shift.id).where(Shift.status == "closed", Shift.archived_at.is_(None))
+                            .order_by(Shift.id)).scalars().all()
+        return {sh_id: self.archive_shift(sh_id, batch_rows) for sh_id in ids}
 
     def get_task(self, shift_id: Optional[int] = None) -> Tuple[List[Dict[str,int]], Dict[str,int]]:
+        sh_id = _read_shift_id(shift_id)
+        with read_session_scope() as s:
+            # id артикулов с реплики в общий кэш не кладём: READ_DATABASE_URL может быть и не физической репликой
+            return _task_snapshot(s, sh_id, remember=False)
+
+    def get_task_changes(self, since_version: int = 0, known_shift_id: Optional[int] = None) -> Dict:
+        """
+        Изменения задания после since_version.
+        -> {"shift_id", "version", "full", "items": [{"article","copies","remaining"}], "deleted": [code]}
+        version — txid: все транзакции с меньшим txid завершены, поэтому его можно передавать как since_version
+        в следующий вызов (строки на границе могут прийти повторно — применять идемпотентно).
+        Если открыта другая смена, чем known_shift_id, возвращается полный снимок (full=True).
+        """
         with session_scope() as s:
-            sh = s.get(Shift, shift_id) if shift_id else _get_open_shift(s)
-            items = s.execute(select(TaskItem).options(joinedload(TaskItem.article)).where(TaskItem.shift_id == sh.id)).scalars().all()
-            articles = [{"article": it.article.code, "copies": it.total_copies} for it in items]
-            remaining = {it.article.code: it.remaining_copies for it in items}
-            return articles, remaining
+            s.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))  # один снимок на все запросы
+            watermark = s.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot()) - 1")).scalar_one()
+            sh_id = _open_shift_id(s)
+            full = not since_version or (known_shift_id is not None and known_shift_id != sh_id)
+            since = 0 if full else since_version
+            rows = s.execute(text("""
+                SELECT a.code, t.article_id, t.total_copies, t.remaining_copies
+                FROM task_items t JOIN articles a ON a.id = t.article_id
+                WHERE t.shift_id = :sh AND t.version > :since
+                ORDER BY t.id
+            """), {"sh": sh_id, "since": since}).all()
+            deleted = [] if full else s.execute(text("""
+                SELECT DISTINCT a.code FROM task_item_tombstones d JOIN articles a ON a.id = d.article_id
+                WHERE d.shift_id = :sh AND d.version > :since
+            """), {"sh": sh_id, "since": since}).scalars().all()
+            remember_article_ids(s, {code: aid for code, aid, _, _ in rows})
+            return {
+                "shift_id": sh_id, "version": int(watermark), "full": full, "deleted": deleted,
+                "items": [{"article": code, "copies": total, "remaining": left} for code, _, total, left in rows],
+            }
 
-    def merge_articles(self, new_items: List[Dict[str,int]]) -> Tuple[List[Dict[str,int]], Dict[str,int], int, int]:
+    def merge_articles(self, new_items: Iterable[Dict[str,int]]) -> Tuple[List[Dict[str,int]], Dict[str,int], int, int]:
+        """
+        Bulk-merge потоком: вход (список или генератор IOService.iter_any) читается пачками по BULK_BATCH_SIZE,
+        дубликаты кодов внутри пачки суммируются, на пачку — один upsert в articles и один
+        INSERT ... ON CONFLICT DO UPDATE в task_items. added/updated считаются по уникальным артикулам
+        (новая позиция / увеличена существующая); в памяти — только множество кодов.
+        """
         added = updated = 0
+        seen = set()
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            for item in new_items:
-                code = item["article"].strip()
-                cp = int(item.get("copies", 1) or 1)
-                art = _get_or_create_article(s, code)
-                ti = s.execute(select(TaskItem).where(TaskItem.shift_id == sh.id, TaskItem.article_id == art.id)).scalar_one_or_none()
-                if ti:
-                    ti.total_copies += cp
-                    ti.remaining_copies += cp
-                    updated += 1
-                else:
-                    s.add(TaskItem(shift_id=sh.id, article_id=art.id, total_copies=cp, remaining_copies=cp))
-                    added += 1
-            s.flush()
-            items = s.execute(select(TaskItem).options(joinedload(TaskItem.article)).where(TaskItem.shift_id == sh.id)).scalars().all()
-            articles = [{"article": it.article.code, "copies": it.total_copies} for it in items]
-            remaining = {it.article.code: it.remaining_copies for it in items}
+            sh_id = _require_open_shift(s)
+            for items in _chunks(new_items):
+                agg: Dict[str, int] = {}
+                for item in items:
+                    code = str(item["article"]).strip()
+                    if code:
+                        agg[code] = agg.get(code, 0) + int(item.get("copies", 1) or 1)
+                if not agg:
+                    continue
+                chunk = list(agg.items())
+                ids = resolve_article_ids(s, (code for code, _ in chunk))
+                ins = pg_insert(TaskItem).values([
+                    {"shift_id": sh_id, "article_id": ids[code], "total_copies": cp, "remaining_copies": cp}
+                    for code, cp in chunk
+                ])
+                ins = ins.on_conflict_do_update(
+                    constraint="uq_taskitem_shift_article",
+                    set_={
+                        "total_copies": TaskItem.total_copies + ins.excluded.total_copies,
+                        "remaining_copies": TaskItem.remaining_copies + ins.excluded.remaining_copies,
+                    },
+                ).returning(TaskItem.article_id, literal_column("(xmax = 0)"))  # xmax = 0 -> строка вставлена, иначе обновлена
+                for art_id, inserted in s.execute(ins):
+                    if art_id in seen:
+                        continue  # код уже встречался в предыдущей пачке этого же файла
+                    seen.add(art_id)
+                    if inserted:
+                        added += 1
+                    else:
+                        updated += 1
+            articles, remaining = _task_snapshot(s, sh_id)
             return articles, remaining, added, updated
 
     def dec_remaining(self, article_code: str, by: int = 1) -> int:
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            art = _get_or_create_article(s, article_code)
+            sh_id = _require_open_shift(s)
+            art_id = _article_id(s, article_code)
             ti = s.execute(
-                select(TaskItem).where(TaskItem.shift_id == sh.id, TaskItem.article_id == art.id).with_for_update()
+                select(TaskItem).where(TaskItem.shift_id == sh_id, TaskItem.article_id == art_id).with_for_update()
             ).scalar_one_or_none()
             if not ti: raise NoResultFound(f"TaskItem not found for {article_code}")
             if by > ti.remaining_copies:
@@ -128,13 +460,13 @@ class TaskRepository:
 
     def inc_remaining(self, article_code: str, by: int = 1) -> int:
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            art = _get_or_create_article(s, article_code)
+            sh_id = _require_open_shift(s)
+            art_id = _article_id(s, article_code)
             ti = s.execute(
-                select(TaskItem).where(TaskItem.shift_id == sh.id, TaskItem.article_id == art.id).with_for_update()
+                select(TaskItem).where(TaskItem.shift_id == sh_id, TaskItem.article_id == art_id).with_for_update()
             ).scalar_one_or_none()
             if not ti:
-                ti = TaskItem(shift_id=sh.id, article_id=art.id, total_copies=by, remaining_copies=by)
+                ti = TaskItem(shift_id=sh_id, article_id=art_id, total_copies=by, remaining_copies=by)
             else:
                 ti.remaining_copies += by
                 if ti.remaining_copies > ti.total_copies:
@@ -143,213 +475,699 @@ class TaskRepository:
             return ti.remaining_copies
 
     def remaining_total(self) -> int:
+        return self.shift_totals()["remaining_copies"]
+
+    def shift_totals(self, shift_id: Optional[int] = None) -> Dict[str, int]:
+        """Итоги смены из shift_stats (O(1): STATS_SLOTS строк), без SUM по task_items."""
+        sh_id = _read_shift_id(shift_id)
+        with read_session_scope() as s:
+            row = s.execute(text("""
+                SELECT COALESCE(SUM(total_copies), 0), COALESCE(SUM(remaining_copies), 0),
+                       COALESCE(SUM(item_count), 0), COALESCE(SUM(completed_count), 0)
+                FROM shift_stats WHERE shift_id = :sh
+            """), {"sh": sh_id}).one()
+            return dict(zip(("total_copies", "remaining_copies", "item_count", "completed_count"), map(int, row)))
+
+    def check_shift_stats(self, shift_id: Optional[int] = None, repair: bool = False) -> List[Dict]:
+        """
+        Пересчитать агрегаты по task_items и сравнить с shift_stats (shift_id=None — все смены).
+        repair=True записывает пересчитанные значения; на время проверки запись в task_items блокируется.
+        -> [{"shift_id", "slot", "stored": (total, remaining, items, completed), "actual": (...)}]
+        """
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            tot = s.execute(select(func.coalesce(func.sum(TaskItem.remaining_copies), 0)).where(TaskItem.shift_id == sh.id)).scalar_one()
-            return int(tot)
+            s.execute(text("LOCK TABLE task_items IN SHARE MODE"))
+            rows = s.execute(text(f"""
+                WITH actual AS (
+                    SELECT shift_id, (id % {STATS_SLOTS})::smallint AS slot,
+                           SUM(total_copies) AS t, SUM(remaining_copies) AS r,
+                           COUNT(*) AS c, COUNT(*) FILTER (WHERE remaining_copies <= 0) AS d
+                    FROM task_items WHERE (CAST(:sh AS bigint) IS NULL OR shift_id = :sh)
+                    GROUP BY 1, 2
+                ), stored AS (
+                    SELECT * FROM shift_stats WHERE (CAST(:sh AS bigint) IS NULL OR shift_id = :sh)
+                )
+                SELECT COALESCE(a.shift_id, st.shift_id), COALESCE(a.slot, st.slot),
+                       COALESCE(st.total_copies, 0), COALESCE(st.remaining_copies, 0),
+                       COALESCE(st.item_count, 0), COALESCE(st.completed_count, 0),
+                       COALESCE(a.t, 0), COALESCE(a.r, 0), COALESCE(a.c, 0), COALESCE(a.d, 0)
+                FROM actual a FULL JOIN stored st ON st.shift_id = a.shift_id AND st.slot = a.slot
+                WHERE (COALESCE(st.total_copies, 0), COALESCE(st.remaining_copies, 0),
+                       COALESCE(st.item_count, 0), COALESCE(st.completed_count, 0))
+                      IS DISTINCT FROM (COALESCE(a.t, 0), COALESCE(a.r, 0), COALESCE(a.c, 0), COALESCE(a.d, 0))
+                ORDER BY 1, 2
+            """), {"sh": shift_id}).all()
+            out = [{"shift_id": r[0], "slot": r[1], "stored": tuple(map(int, r[2:6])), "actual": tuple(map(int, r[6:10]))}
+                   for r in rows]
+            if repair and out:
+                s.execute(pg_insert(ShiftStats).values([
+                    {"shift_id": m["shift_id"], "slot": m["slot"], "total_copies": m["actual"][0],
+                     "remaining_copies": m["actual"][1], "item_count": m["actual"][2], "completed_count": m["actual"][3]}
+                    for m in out
+                ]).on_conflict_do_update(
+                    index_elements=[ShiftStats.shift_id, ShiftStats.slot],
+                    set_={c: literal_column(f"EXCLUDED.{c}") for c in
+                          ("total_copies", "remaining_copies", "item_count", "completed_count")},
+                ))
+            return out
 
-    def pick_random_available_and_decrement(self) -> tuple[str, int] | None:
+    def pick_next_available_and_decrement(self, order: str = "fifo", dispatcher=None) -> tuple[str, int] | None:
+        """order: random | fifo | largest | weighted (см. app/services/task_picker.py); dispatcher — ShardDispatcher."""
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            if not sh:
+            sh_id = _open_shift_id(s)
+            if not sh_id:
                 return None
-            stmt = (
-                select(TaskItem)
-                .where(TaskItem.shift_id == sh.id, TaskItem.remaining_copies > 0)
-                .order_by(func.random())
-                .limit(1)
-                .with_for_update(skip_locked=True)
-            )
-            ti = s.execute(stmt).scalar_one_or_none()
-            if not ti:
+            tid = pick_task_item_id(s, sh_id, order, dispatcher)
+            if tid is None:
                 return None
-            ti.remaining_copies -= 1
-            code = s.get(Article, ti.article_id).code
-            left = ti.remaining_copies
-            s.add(ti); s.flush()
+            code, left = s.execute(text("""
+                UPDATE task_items t SET remaining_copies = t.remaining_copies - 1
+                FROM articles a
+                WHERE t.id = :id AND a.id = t.article_id
+                RETURNING a.code, t.remaining_copies
+            """), {"id": tid}).one()
             return code, left
 
+    def pick_random_available_and_decrement(self) -> tuple[str, int] | None:
+        return self.pick_next_available_and_decrement("random")
+
+    def collect_one(self, collector: str, order: str = "random", at: Optional[datetime] = None,
+                    op_id: Optional[str] = None, dispatcher=None) -> Optional[Dict]:
+        """
+        Единица работы «Собрать» одним запросом: выбор позиции, уменьшение remaining,
+        запись CollectorHistory и новые итоги смены.
+        -> {"article", "left", "remaining_total", "history_id", "datetime"} или None, если собирать нечего.
+        op_id — клиентский id операции, at фиксируется вместе с ним до первой попытки: если сборка
+        (op_id, at) уже записана, тот же запрос возвращает её результат и ничего не списывает.
+        dispatcher — ShardDispatcher рабочего места: позиция ищется сначала в его шарде (см. task_picker.first_pick).
+        """
+        at = at or datetime.utcnow()
+
+        def work(s):
+            sh_id = _open_shift_id(s, create_if_absent=False)  # смена закрыта — не открываем пустую новую
+            if not sh_id:
+                return None
+
+            def run(pick, extra):
+                return s.execute(text(f"""
+                    WITH done AS (
+                        SELECT id, article_id, occurred_at FROM collector_history
+                        WHERE op_id = :op_id AND occurred_at = :at
+                    ),
+                    pick AS (SELECT p.id FROM ({pick}) p WHERE NOT EXISTS (SELECT 1 FROM done)),
+                    dec AS (
+                        UPDATE task_items t SET remaining_copies = t.remaining_copies - 1
+                        FROM pick WHERE t.id = pick.id
+                        RETURNING t.article_id, t.remaining_copies
+                    ),
+                    hist AS (
+                        INSERT INTO collector_history (shift_id, article_id, collector, occurred_at, copies, op_id)
+                        SELECT :shift_id, dec.article_id, :collector, :at, 1, :op_id FROM dec
+                        RETURNING id, occurred_at
+                    ),
+                    res AS (
+                        -- снимок shift_stats до UPDATE этого же запроса (триггер отработает позже), поэтому -1
+                        SELECT dec.article_id, dec.remaining_copies AS remaining, hist.id, hist.occurred_at, -1 AS pending
+                        FROM dec CROSS JOIN hist
+                        UNION ALL
+                        SELECT done.article_id, COALESCE(t.remaining_copies, 0), done.id, done.occurred_at, 0
+                        FROM done LEFT JOIN task_items t ON t.shift_id = :shift_id AND t.article_id = done.article_id
+                    )
+                    SELECT a.code, res.article_id, res.remaining, res.id, res.occurred_at,
+                           (SELECT COALESCE(SUM(remaining_copies), 0) FROM shift_stats WHERE shift_id = :shift_id) + res.pending
+                    FROM res JOIN articles a ON a.id = res.article_id
+                """), {"shift_id": sh_id, "collector": collector, "at": at, "op_id": op_id, **extra}).first()
+            row = first_pick(order, run, dispatcher)
+            if row is None:
+                return None
+            code, art_id, left, hist_id, when, total = row
+            remember_article_ids(s, {code: art_id})
+            return {"article": code, "left": left, "remaining_total": int(total), "history_id": hist_id,
+                    "datetime": when.strftime("%Y-%m-%d %H:%M:%S")}
+
+        return _run_op(work, "collect_one", op_id)
+
+    def undo_collect(self, history_id: int) -> Optional[int]:
+        """
+        Откат collect_one (например, печать не удалась): удалить запись истории и вернуть копии в задание.
+        Идемпотентен: повторный вызов не находит запись и ничего не возвращает в задание.
+        """
+        def work(s):
+            return s.execute(text("""
+                WITH h AS (DELETE FROM collector_history WHERE id = :hid RETURNING shift_id, article_id, copies)
+                UPDATE task_items t SET remaining_copies = t.remaining_copies + h.copies
+                FROM h WHERE t.shift_id = h.shift_id AND t.article_id = h.article_id
+                RETURNING t.remaining_copies
+            """), {"hid": history_id}).scalar()
+        return _run_op(work, "undo_collect", None)
+
+    # --- аренды ---
+    def reserve(self, collector: str, order: str = "random", ttl_s: float = LEASE_TTL_S,
+                op_id: Optional[str] = None, dispatcher=None) -> Optional[Dict]:
+        """
+        Выбрать позицию и зарезервировать одну её копию на ttl_s секунд: reserved_copies + 1 и строка
+        task_leases одним запросом; remaining и история не меняются до confirm_lease.
+        Повтор с тем же op_id возвращает ту же аренду; dispatcher — как в collect_one.
+        -> {"lease_id", "op_id", "task_item_id", "article", "expires_at"} или None, если собирать нечего.
+        """
+        op_id = op_id or str(uuid.uuid4())
+
+        def work(s):
+            sh_id = _open_shift_id(s, create_if_absent=False)
+            if not sh_id:
+                return None
+
+            def run(pick, extra):
+                return s.execute(text(f"""
+                    WITH done AS (
+                        SELECT id, task_item_id, expires_at FROM task_leases WHERE op_id = :op_id
+                    ),
+                    pick AS (SELECT p.id FROM ({pick}) p WHERE NOT EXISTS (SELECT 1 FROM done)),
+                    res AS (
+                        UPDATE task_items t SET reserved_copies = t.reserved_copies + 1
+                        FROM pick WHERE t.id = pick.id
+                        RETURNING t.id
+                    ),
+                    lease AS (
+                        INSERT INTO task_leases (task_item_id, collector, op_id, expires_at)
+                        SELECT res.id, :collector, :op_id, now() + make_interval(secs => :ttl) FROM res
+                        RETURNING id, task_item_id, expires_at
+                    ),
+                    out AS (SELECT * FROM lease UNION ALL SELECT * FROM done)
+                    SELECT out.id, out.task_item_id, a.code, out.expires_at
+                    FROM out JOIN task_items t ON t.id = out.task_item_id JOIN articles a ON a.id = t.article_id
+                """), {"shift_id": sh_id, "collector": collector, "op_id": op_id, "ttl": float(ttl_s), **extra}).first()
+            row = first_pick(order, run, dispatcher)
+            if row is None:
+                return None
+            lease_id, item_id, code, expires = row
+            return {"lease_id": lease_id, "op_id": op_id, "task_item_id": item_id, "article": code, "expires_at": expires}
+
+        return _run_op(work, "reserve", op_id)
+
+    def reserve_many(self, collector: str, n: int, order: str = "random", ttl_s: float = LEASE_TTL_S,
+                     op_id: Optional[str] = None, dispatcher=None) -> List[Dict]:
+        """
+        «Собрать N»: одним запросом на попытку зарезервировать до n копий по нескольким позициям — доступные позиции
+        подряд по id (см. task_picker.batch_attempts), с каждой берётся сколько свободно, пока не набралось n;
+        на каждую копию своя аренда с op_id = uuid(md5(op_id:k)), поэтому повтор с тем же op_id
+        возвращает те же аренды. С dispatcher недобор в своём шарде добирается из следующих шардов и затем
+        из всей смены (task_picker.fill_picks). -> [аренда как в reserve] (меньше n, если свободных копий меньше).
+        """
+        n = int(n)
+        if n <= 0:
+            return []
+        op_id = op_id or str(uuid.uuid4())
+
+        def work(s):
+            sh_id = _open_shift_id(s, create_if_absent=False)
+            if not sh_id:
+                return []
+
+            out_sql = """
+                SELECT out.id, out.op_id, out.task_item_id, a.code, out.expires_at
+                FROM out JOIN task_items t ON t.id = out.task_item_id JOIN articles a ON a.id = t.article_id
+                ORDER BY out.id
+            """
+            # повтор операции: аренды с этим op_id уже выданы — возвращаем их
+            done = s.execute(text(f"""
+                WITH out AS (
+                    SELECT id, task_item_id, op_id, expires_at FROM task_leases
+                    WHERE op_id IN (SELECT md5(:op_id || ':' || k)::uuid::text FROM generate_series(1, :n) k)
+                ) {out_sql}
+            """), {"op_id": op_id, "n": n}).all()
+            if done:
+                return [{"lease_id": lease_id, "op_id": lop, "task_item_id": item_id, "article": code, "expires_at": expires}
+                        for lease_id, lop, item_id, code, expires in done]
+
+            def run(cond, extra, need):
+                start = start_sql(cond)
+                # окно не больше need позиций в каждой ветке: у каждой хотя бы одна свободная копия;
+                # k0 — сколько аренд уже выдано предыдущими попытками этой операции
+                return s.execute(text(f"""
+                    -- FOR UPDATE внутри UNION запрещён — ветки обхода отдельными CTE
+                    WITH tail AS (
+                        SELECT id, remaining_copies - reserved_copies AS free, 0 AS br FROM task_items
+                        WHERE shift_id = :shift_id AND {cond} AND id >= {start}
+                        ORDER BY id LIMIT :n FOR UPDATE SKIP LOCKED
+                    ),
+                    head AS (
+                        SELECT id, remaining_copies - reserved_copies AS free, 1 AS br FROM task_items
+                        WHERE shift_id = :shift_id AND {cond} AND id < {start}
+                        ORDER BY id LIMIT :n FOR UPDATE SKIP LOCKED
+                    ),
+                    cand AS (SELECT * FROM tail UNION ALL SELECT * FROM head),
+                    alloc AS (
+                        SELECT id, LEAST(free, :n - COALESCE(SUM(free) OVER (
+                                   ORDER BY br, id ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0)) AS take
+                        FROM cand
+                    ),
+                    res AS (
+                        UPDATE task_items t SET reserved_copies = t.reserved_copies + alloc.take
+                        FROM alloc WHERE t.id = alloc.id AND alloc.take > 0
+                        RETURNING t.id, alloc.take
+                    ),
+                    units AS (
+                        SELECT res.id AS task_item_id, :k0 + row_number() OVER (ORDER BY res.id, g) AS k
+                        FROM res CROSS JOIN LATERAL generate_series(1, res.take) g
+                    ),
+                    lease AS (
+                        INSERT INTO task_leases (task_item_id, collector, op_id, expires_at)
+                        SELECT task_item_id, :collector, md5(:op_id || ':' || k)::uuid::text,
+                               now() + make_interval(secs => :ttl)
+                        FROM units
+                        RETURNING id, task_item_id, op_id, expires_at
+                    ),
+                    out AS (SELECT * FROM lease)
+                    {out_sql}
+                """), {"shift_id": sh_id, "collector": collector, "op_id": op_id, "n": need, "k0": n - need,
+                       "ttl": float(ttl_s), **extra}).all()
+
+            rows = fill_picks(order, run, n, dispatcher)
+            return [{"lease_id": lease_id, "op_id": lop, "task_item_id": item_id, "article": code, "expires_at": expires}
+                    for lease_id, lop, item_id, code, expires in rows]
+
+        return _run_op(work, "reserve_many", op_id)
+
+    def confirm_leases(self, leases: List[Dict], collector: str, at: Optional[datetime] = None) -> Dict:
+        """
+        Напечатано: одним запросом снять аренды, списать копии (remaining и reserved по позициям) и записать
+        по строке CollectorHistory на копию одним INSERT, с op_id её аренды. Аренды, уже снятые по сроку,
+        списываются сверх резервов, пока у позиции есть свободные копии. Копии, подтверждение которых уже
+        записано, возвращаются без повторного списания — повтор вызова безопасен.
+        -> {"items": [{"article", "left", "history_id", "datetime"}], "remaining_total"}; items в порядке id истории,
+        без копий, которые списать не удалось.
+        """
+        if not leases:
+            return {"items": [], "remaining_total": None}
+        at = at or datetime.utcnow()
+
+        def work(s):
+            rows = s.execute(text("""
+                WITH req AS (
+                    SELECT * FROM unnest(CAST(:lids AS bigint[]), CAST(:ops AS text[]), CAST(:tids AS bigint[]))
+                        AS r(lease_id, op_id, task_item_id)
+                ),
+                done AS (
+                    SELECT h.shift_id, h.id, h.article_id, h.occurred_at, h.op_id
+                    FROM collector_history h JOIN req ON h.op_id = req.op_id
+                ),
+                l AS (
+                    DELETE FROM task_leases tl USING req
+                    WHERE tl.id = req.lease_id AND tl.op_id = req.op_id
+                      AND NOT EXISTS (SELECT 1 FROM done WHERE done.op_id = req.op_id)
+                    RETURNING tl.task_item_id, tl.op_id
+                ),
+                -- аренда уже снята уборщиком: копию можно взять только из свободных
+                late AS (
+                    SELECT r.task_item_id, r.op_id, row_number() OVER (PARTITION BY r.task_item_id ORDER BY r.op_id) AS rn
+                    FROM req r
+                    WHERE NOT EXISTS (SELECT 1 FROM l WHERE l.op_id = r.op_id)
+                      AND NOT EXISTS (SELECT 1 FROM done WHERE done.op_id = r.op_id)
+                ),
+                cur AS (
+                    SELECT t.id, t.remaining_copies - t.reserved_copies AS free FROM task_items t
+                    WHERE t.id IN (SELECT task_item_id FROM l UNION SELECT task_item_id FROM late)
+                    ORDER BY t.id
+                    FOR UPDATE
+                ),
+                -- cur блокирует позиции по возрастанию id до UPDATE: параллельные пачки не образуют цикл ожидания
+                units AS (
+                    SELECT l.task_item_id, l.op_id, 1 AS leased FROM l JOIN cur ON cur.id = l.task_item_id
+                    UNION ALL
+                    SELECT late.task_item_id, late.op_id, 0 FROM late JOIN cur ON cur.id = late.task_item_id
+                    WHERE late.rn <= cur.free
+                ),
+                per AS (SELECT task_item_id, count(*) AS taken, SUM(leased) AS leased FROM units GROUP BY 1),
+                dec AS (
+                    UPDATE task_items t SET remaining_copies = t.remaining_copies - per.taken,
+                                            reserved_copies = GREATEST(t.reserved_copies - per.leased, 0)
+                    FROM per WHERE t.id = per.task_item_id
+                    RETURNING t.id, t.shift_id, t.article_id, t.remaining_copies
+                ),
+                hist AS (
+                    INSERT INTO collector_history (shift_id, article_id, collector, occurred_at, copies, op_id)
+                    SELECT dec.shift_id, dec.article_id, :collector, :at, 1, units.op_id
+                    FROM units JOIN dec ON dec.id = units.task_item_id
+                    ORDER BY units.task_item_id, units.op_id
+                    RETURNING id, shift_id, article_id, occurred_at
+                ),
+                res AS (
+                    SELECT hist.shift_id, hist.article_id, dec.remaining_copies AS remaining, hist.id, hist.occurred_at
+                    FROM hist JOIN dec ON dec.shift_id = hist.shift_id AND dec.article_id = hist.article_id
+                    UNION ALL
+                    SELECT done.shift_id, done.article_id, COALESCE(t.remaining_copies, 0), done.id, done.occurred_at
+                    FROM done LEFT JOIN task_items t ON t.shift_id = done.shift_id AND t.article_id = done.article_id
+                )
+                -- снимок shift_stats до UPDATE этого же запроса (триггер отработает позже), поэтому - count(hist)
+                SELECT a.code, res.article_id, res.remaining, res.id, res.occurred_at,
+                       (SELECT COALESCE(SUM(remaining_copies), 0) FROM shift_stats WHERE shift_id = res.shift_id)
+                       - (SELECT count(*) FROM hist)
+                FROM res JOIN articles a ON a.id = res.article_id
+                ORDER BY res.id
+            """), {"lids": [l["lease_id"] for l in leases], "ops": [l["op_id"] for l in leases],
+                   "tids": [l["task_item_id"] for l in leases], "collector": collector, "at": at}).all()
+            remember_article_ids(s, {code: art_id for code, art_id, *_ in rows})
+            return {"items": [{"article": code, "left": left, "history_id": hist_id,
+                               "datetime": when.strftime("%Y-%m-%d %H:%M:%S")}
+                              for code, _, left, hist_id, when, _ in rows],
+                    "remaining_total": int(rows[-1][5]) if rows else None}
+
+        return _run_op(work, "confirm_leases", leases[0]["op_id"])
+
+    def confirm_lease(self, lease: Dict, collector: str, at: Optional[datetime] = None) -> Optional[Dict]:
+        """
+        Подтверждение одной аренды (см. confirm_leases).
+        -> как collect_one; None — списать нечего (позиция удалена или всё разобрано).
+        """
+        res = self.confirm_leases([lease], collector, at)
+        if not res["items"]:
+            return None
+        return {**res["items"][0], "remaining_total": res["remaining_total"]}
+
+    def release_leases(self, lease_ids: List[int]) -> int:
+        """Печать не удалась: снять аренды, копии снова доступны. Идемпотентен; -> сколько аренд снято."""
+        if not lease_ids:
+            return 0
+
+        def work(s):
+            return s.execute(text("""
+                WITH l AS (DELETE FROM task_leases WHERE id = ANY(CAST(:ids AS bigint[])) RETURNING task_item_id),
+                agg AS (SELECT task_item_id, count(*) AS n FROM l GROUP BY 1),
+                upd AS (
+                    UPDATE task_items t SET reserved_copies = GREATEST(t.reserved_copies - agg.n, 0)
+                    FROM agg WHERE t.id = agg.task_item_id
+                    RETURNING t.id
+                )
+                SELECT count(*) FROM l
+            """), {"ids": [int(i) for i in lease_ids]}).scalar_one()
+        return _run_op(work, "release_leases", None)
+
+    def release_lease(self, lease_id: int) -> bool:
+        """Снять одну аренду; False — её уже нет."""
+        return self.release_leases([lease_id]) > 0
+
+    def sweep_expired_leases(self, limit: int = LEASE_SWEEP_BATCH) -> int:
+        """
+        Снять до limit истёкших аренд одной транзакцией и вернуть их копии (reserved_copies) в очередь.
+        Уборщик один на все рабочие места (advisory-lock); занятый другим — возвращает 0.
+        """
+        def work(s):
+            if not s.execute(text("SELECT pg_try_advisory_xact_lock(:k)"), {"k": _LEASE_SWEEP_LOCK_KEY}).scalar():
+                return 0
+            return s.execute(text("""
+                WITH l AS (
+                    DELETE FROM task_leases WHERE id IN (
+                        SELECT id FROM task_leases WHERE expires_at < now()
+                        ORDER BY id LIMIT :n FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING task_item_id
+                ),
+                agg AS (SELECT task_item_id, count(*) AS n FROM l GROUP BY 1),
+                upd AS (
+                    UPDATE task_items t SET reserved_copies = GREATEST(t.reserved_copies - agg.n, 0)
+                    FROM agg WHERE t.id = agg.task_item_id
+                    RETURNING t.id
+                )
+                SELECT count(*) FROM l
+            """), {"n": limit}).scalar_one()
+        return run_in_transaction(work, name="sweep_leases")
 
     # --- импорт/экспорт задания ---
-    def import_task_rows(self, rows: list[dict], mode: str = "merge") -> None:
+    def import_task_rows(self, rows: Iterable[dict], mode: str = "merge", fine_locks: bool = True) -> None:
         """
         rows: [{article: str, total: int, remaining: Optional[int]}]
         mode="merge"  -> += total/remaining по каждой позиции
-        mode="replace"-> удалить текущее задание и загрузить новое
+        mode="replace"-> удалить текущее задание и загрузить новое; пустой rows -> ValueError (задание не стирается)
+
+        Строки льются COPY во временную таблицу до взятия блокировок;
+        под блокировкой выполняются только set-based DELETE/INSERT ... ON CONFLICT.
+        fine_locks=True: READ COMMITTED + блокировки только слотов затронутых артикулов (_import_lock),
+        строки task_items блокируются по возрастанию article_id. False — SERIALIZABLE и lock всей смены.
+        На 40001/40P01 транзакция повторяется целиком, если rows повторно итерируем — список или CsvRows (см. _run_import).
         """
         mode = (mode or "merge").lower()
         if mode not in ("merge", "replace"):
             raise ValueError("mode must be 'merge' or 'replace'")
 
-        with session_scope_serializable() as s:
-            sh = _get_open_shift(s)
-            advisory_xact_lock(s, sh.id)  # блокируем смену на время импорта
+        def work(s):
+            create_staging_table(s, "stg_task", "code text NOT NULL, total int NOT NULL, remaining int NOT NULL")
+            staged = copy_into(s, "stg_task", ("code", "total", "remaining"), _task_staging_rows(rows))
+            if mode == "replace" and not staged:
+                raise ValueError("replace with an empty task: no rows to import")
+            s.execute(text("INSERT INTO articles (code) SELECT DISTINCT code FROM stg_task ON CONFLICT (code) DO NOTHING"))
 
-            if mode == "replace":
-                s.execute(delete(TaskItem).where(TaskItem.shift_id == sh.id))
+            sh_id = _require_open_shift(s)
+            _import_lock(s, sh_id, "stg_task", fine_locks, whole_shift=(mode == "replace"))
 
-            for r in rows:
-                code = str(r["article"]).strip()
-                if not code:
-                    continue
-                total = int(r.get("total") or r.get("copies") or 1)
-                remaining = r.get("remaining")
-                remaining = total if remaining is None else int(remaining)
-
-                art = _get_or_create_article(s, code)
-                ti = s.execute(
-                    select(TaskItem).where(TaskItem.shift_id == sh.id, TaskItem.article_id == art.id).with_for_update()
-                ).scalar_one_or_none()
+            if mode == "replace":
+                s.execute(delete(TaskItem).where(TaskItem.shift_id == sh_id))
+            s.execute(text("""
+                INSERT INTO task_items (shift_id, article_id, total_copies, remaining_copies)
+                SELECT :sh, a.id, SUM(g.total), SUM(g.remaining)
+                FROM stg_task g JOIN articles a ON a.code = g.code
+                GROUP BY a.id
+                ORDER BY a.id
+                ON CONFLICT ON CONSTRAINT uq_taskitem_shift_article DO UPDATE
+                SET total_copies = task_items.total_copies + EXCLUDED.total_copies,
+                    remaining_copies = task_items.remaining_copies + EXCLUDED.remaining_copies
+            """), {"sh": sh_id})
 
-                if ti:
-                    ti.total_copies += total
-                    ti.remaining_copies += remaining
-                else:
-                    s.add(TaskItem(shift_id=sh.id, article_id=art.id, total_copies=total, remaining_copies=remaining))
+        _run_import(work, rows, "import_task", fine_locks)
 
     def export_task_to_csv(self, file_path: str, shift_id: int | None = None) -> str:
-        import csv, os
-        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
-        with session_scope() as s, open(file_path, "w", encoding="utf-8-sig", newline="") as f:
-            w = csv.writer(f, delimiter=';')
-            w.writerow(["Артикул", "Количество", "Осталось"])
-            sh = s.get(Shift, shift_id) if shift_id else _get_open_shift(s)
-            items = s.execute(
-                select(TaskItem).options(joinedload(TaskItem.article)).where(TaskItem.shift_id == sh.id)
-            ).scalars().all()
-            for it in items:
-                w.writerow([it.article.code, it.total_copies, it.remaining_copies])
-        return file_path
+        sh_id = _read_shift_id(shift_id)
+        with read_session_scope() as s:
+            # задание закрытой смены могло уйти в архив (archive_shift)
+            items = _with_archive("task_items", "task_items_archive", "id, shift_id, article_id, total_copies, remaining_copies")
+            return export_query_to_csv(s, f"""
+                SELECT a.code, t.total_copies, t.remaining_copies
+                FROM {items} t JOIN articles a ON a.id = t.article_id
+                WHERE t.shift_id = :sh
+                ORDER BY t.id
+            """, {"sh": sh_id}, file_path, ["Артикул", "Количество", "Осталось"])
 
 # --- History ---
+# размер страницы истории по умолчанию (вкладки UI подгружают старые записи при прокрутке)
+HISTORY_PAGE_SIZE = 200
+
+def _history_page(session, model, cols, shift_id: int, cursor_id: Optional[int], limit: Optional[int], newest_first: bool):
+    """Keyset-страница истории смены по id: newest_first -> id < cursor по убыванию, иначе id > cursor по возрастанию."""
+    if shift_id is None:
+        return []
+    stmt = (select(model.id, Article.code, *cols, model.occurred_at)
+            .join(Article, model.article_id == Article.id, isouter=True)
+            .where(model.shift_id == shift_id))
+    if newest_first:
+        if cursor_id is not None: stmt = stmt.where(model.id < cursor_id)
+        stmt = stmt.order_by(model.id.desc())
+    else:
+        if cursor_id is not None: stmt = stmt.where(model.id > cursor_id)
+        stmt = stmt.order_by(model.id.asc())
+    if limit:
+        stmt = stmt.limit(limit)
+    return session.connection().execute(stmt).all()  # только колонки — ORM-слой сессии не нужен
+
+def _history_export_sql(table: str, cols: str, shift_id: Optional[int], date_from, date_to,
+                        all_shifts: bool = False) -> Tuple[str, Dict]:
+    """
+    SELECT для выгрузки истории: код артикула, cols ({dt} — отформатированное время), фильтры по смене и датам.
+    all_shifts=True — все смены; при партиционировании фильтр по датам отсекает лишние месячные партиции.
+    Читаются и строки {table}_archive — история закрытых смен после archive_shift.
+    """
+    where, params = ["TRUE"], {}
+    if not all_shifts:
+        where.append("h.shift_id = :sh"); params["sh"] = shift_id
+    if date_from:
+        where.append("h.occurred_at >= :date_from"); params["date_from"] = date_from
+    if date_to:
+        where.append("h.occurred_at < :date_to"); params["date_to"] = date_to
+    cols = cols.format(dt="to_char(h.occurred_at, 'YYYY-MM-DD HH24:MI:SS')")
+    archive = {"collector_history": CollectorHistoryArchive, "check_history": CheckHistoryArchive}[table].__table__
+    return f"""
+        SELECT a.code, {cols}
+        FROM {_with_archive(table, archive.name, ", ".join(c.name for c in archive.columns))} h LEFT JOIN articles a ON a.id = h.article_id
+        WHERE {" AND ".join(where)}
+        ORDER BY h.id
+    """, params
+
 class HistoryRepository:
     def add_collect(self, article_code: str, collector: str, copies: int = 1, at: Optional[datetime] = None) -> None:
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            art = _get_or_create_article(s, article_code)
-            rec = CollectorHistory(shift_id=sh.id, article_id=art.id, collector=collector,
+            sh_id = _require_open_shift(s)
+            art_id = _article_id(s, article_code)
+            rec = CollectorHistory(shift_id=sh_id, article_id=art_id, collector=collector,
                                    occurred_at=at or datetime.utcnow(), copies=copies)
             s.add(rec)
 
-    def get_collect(self) -> List[Dict]:
+    def add_collect_many(self, events: Iterable[dict]) -> int:
+        """
+        События сборки {article, collector, copies, occurred_at?, op_id?, shift_id?} одной транзакцией.
+        Без shift_id — текущая открытая смена (нет открытой — shift_id NULL).
+        """
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            rows = s.execute(
-                select(CollectorHistory, Article.code)
-                .join(Article, CollectorHistory.article_id == Article.id, isouter=True)
-                .where(CollectorHistory.shift_id == sh.id)
-                .order_by(CollectorHistory.id.asc())
-            ).all()
-            out = []
-            for rec, code in rows:
-                out.append({"article": code or "", "collector": rec.collector,
-                            "datetime": rec.occurred_at.strftime("%Y-%m-%d %H:%M:%S"), "copies": rec.copies})
-            return out
+            return _history_batch(s, CollectorHistory, events, {
+                "collector": lambda e: e.get("collector") or "",
+                "copies": lambda e: int(e.get("copies") or 1),
+            })
 
-    def cancel_last_collect(self) -> Optional[Dict]:
-        with session_scope() as s:
-            sh = _get_open_shift(s)
-            rec = s.execute(select(CollectorHistory).where(CollectorHistory.shift_id == sh.id)
+    def get_collect(self) -> List[Dict]:
+        sh_id = _read_shift_id()
+        with read_session_scope() as s:
+            rows = collect_rows(s, sh_id)
+            return [{"article": code or "", "collector": collector,
+                     "datetime": when.strftime("%Y-%m-%d %H:%M:%S"), "copies": copies}
+                    for _, code, collector, copies, when in rows]
+
+    def get_collect_page(self, cursor_id: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE, newest_first: bool = True) -> List[Dict]:
+        """Страница истории сборки; курсор — id последней записи предыдущей страницы."""
+        sh_id = _read_shift_id()
+        with read_session_scope() as s:
+            rows = _history_page(s, CollectorHistory, (CollectorHistory.collector, CollectorHistory.copies),
+                                 sh_id, cursor_id, limit, newest_first)
+            return [{"id": rid, "article": code or "", "collector": collector,
+                     "datetime": when.strftime("%Y-%m-%d %H:%M:%S"), "copies": copies}
+                    for rid, code, collector, copies, when in rows]
+
+    def get_collect_tail(self, since_id: int, limit: Optional[int] = None) -> List[Dict]:
+        """Записи сборки с id > since_id по возрастанию."""
+        return self.get_collect_page(since_id, limit, newest_first=False)
+
+    def cancel_last_collect(self, op_id: Optional[str] = None, restore_remaining: bool = False) -> Optional[Dict]:
+        """
+        Удалить последнюю запись сборки смены; restore_remaining — в той же транзакции вернуть её копии в задание.
+        Повтор с тем же op_id возвращает результат первого вызова (operation_log) и не отменяет следующую запись.
+        """
+        def apply(s):
+            sh_id = _open_shift_id(s, create_if_absent=False)
+            if not sh_id: return None
+            rec = s.execute(select(CollectorHistory).where(CollectorHistory.shift_id == sh_id)
                             .order_by(CollectorHistory.id.desc()).limit(1)).scalar_one_or_none()
             if not rec: return None
             code = s.get(Article, rec.article_id).code if rec.article_id else ""
             s.delete(rec); s.flush()
+            if restore_remaining and rec.article_id:
+                s.execute(update(TaskItem).where(TaskItem.shift_id == sh_id, TaskItem.article_id == rec.article_id)
+                          .values(remaining_copies=TaskItem.remaining_copies + rec.copies,
+                                  total_copies=func.greatest(TaskItem.total_copies, TaskItem.remaining_copies + rec.copies)))
             return {"article": code, "collector": rec.collector,
                     "datetime": rec.occurred_at.strftime("%Y-%m-%d %H:%M:%S"), "copies": rec.copies}
+        return _run_op(lambda s: _once(s, op_id, "cancel_collect", apply), "cancel_collect", op_id)
 
     def add_check(self, article_code: str, inspector: str, at: Optional[datetime] = None) -> None:
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            art = _get_or_create_article(s, article_code)
-            rec = CheckHistory(shift_id=sh.id, article_id=art.id, inspector=inspector,
+            sh_id = _require_open_shift(s)
+            art_id = _article_id(s, article_code)
+            rec = CheckHistory(shift_id=sh_id, article_id=art_id, inspector=inspector,
                                occurred_at=at or datetime.utcnow())
             s.add(rec)
 
-    def get_check(self) -> List[Dict]:
-        with session_scope() as s:
-            sh = _get_open_shift(s)
-            rows = s.execute(
-                select(CheckHistory, Article.code)
-                .join(Article, CheckHistory.article_id == Article.id, isouter=True)
-                .where(CheckHistory.shift_id == sh.id)
-                .order_by(CheckHistory.id.asc())
-            ).all()
-            return [{"article": code or "", "inspector": rec.inspector,
-                     "datetime": rec.occurred_at.strftime("%Y-%m-%d %H:%M:%S")} for rec, code in rows]
-
-    def cancel_last_check(self) -> Optional[Dict]:
+    def add_check_many(self, events: Iterable[dict]) -> int:
+        """События проверки {article, inspector, occurred_at?, op_id?, shift_id?} одной транзакцией."""
         with session_scope() as s:
-            sh = _get_open_shift(s)
-            rec = s.execute(select(CheckHistory).where(CheckHistory.shift_id == sh.id)
+            return _history_batch(s, CheckHistory, events, {"inspector": lambda e: e.get("inspector") or ""})
+
+    def get_check(self) -> List[Dict]:
+        sh_id = _read_shift_id()
+        with read_session_scope() as s:
+            rows = check_rows(s, sh_id)
+            return [{"article": code or "", "inspector": inspector,
+                     "datetime": when.strftime("%Y-%m-%d %H:%M:%S")} for _, code, inspector, when in rows]
+
+    def get_check_page(self, cursor_id: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE, newest_first: bool = True) -> List[Dict]:
+        sh_id = _read_shift_id()
+        with read_session_scope() as s:
+            rows = _history_page(s, CheckHistory, (CheckHistory.inspector,),
+                                 sh_id, cursor_id, limit, newest_first)
+            return [{"id": rid, "article": code or "", "inspector": inspector,
+                     "datetime": when.strftime("%Y-%m-%d %H:%M:%S")}
+                    for rid, code, inspector, when in rows]
+
+    def get_check_tail(self, since_id: int, limit: Optional[int] = None) -> List[Dict]:
+        return self.get_check_page(since_id, limit, newest_first=False)
+
+    def cancel_last_check(self, op_id: Optional[str] = None) -> Optional[Dict]:
+        """Удалить последнюю запись проверки смены; повтор с тем же op_id — результат первого вызова."""
+        def apply(s):
+            sh_id = _open_shift_id(s, create_if_absent=False)
+            if not sh_id: return None
+            rec = s.execute(select(CheckHistory).where(CheckHistory.shift_id == sh_id)
                             .order_by(CheckHistory.id.desc()).limit(1)).scalar_one_or_none()
             if not rec: return None
             code = s.get(Article, rec.article_id).code if rec.article_id else ""
             s.delete(rec); s.flush()
             return {"article": code, "inspector": rec.inspector,
                     "datetime": rec.occurred_at.strftime("%Y-%m-%d %H:%M:%S")}
+        return _run_op(lambda s: _once(s, op_id, "cancel_check", apply), "cancel_check", op_id)
 
     # --- импорт/экспорт историй ---
-    def import_collector_rows(self, rows: list[dict], apply_to_remaining: bool = False) -> None:
-        with session_scope_serializable() as s:
-            sh = _get_open_shift(s)
-            advisory_xact_lock(s, sh.id)
-            for r in rows:
-                code = str(r.get("article","")).strip()
-                if not code: continue
-                art = _get_or_create_article(s, code)
-                copies = int(r.get("copies", 1) or 1)
-                when = r.get("datetime")
-                s.add(CollectorHistory(shift_id=sh.id, article_id=art.id,
-                                       collector=r.get("collector",""), occurred_at=when, copies=copies))
-                if apply_to_remaining:
-                    ti = s.execute(select(TaskItem).where(TaskItem.shift_id == sh.id, TaskItem.article_id == art.id)
-                                   .with_for_update()).scalar_one_or_none()
-                    if ti:
-                        ti.remaining_copies = max(0, ti.remaining_copies - copies)
-                        s.add(ti)
-
-    def export_collector_to_csv(self, file_path: str, shift_id: int | None = None, date_from=None, date_to=None) -> str:
-        import csv, os
-        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
-        with session_scope() as s, open(file_path, "w", encoding="utf-8-sig", newline="") as f:
-            w = csv.writer(f, delimiter=';')
-            w.writerow(["Артикул", "Сборщик", "Дата и время", "Количество"])
-            sh = s.get(Shift, shift_id) if shift_id else _get_open_shift(s)
-            stmt = (select(CollectorHistory, Article.code)
-                    .join(Article, CollectorHistory.article_id == Article.id, isouter=True)
-                    .where(CollectorHistory.shift_id == sh.id)
-                    .order_by(CollectorHistory.id.asc()))
-            if date_from: stmt = stmt.where(CollectorHistory.occurred_at >= date_from)
-            if date_to:   stmt = stmt.where(CollectorHistory.occurred_at < date_to)
-            for rec, code in s.execute(stmt).all():
-                w.writerow([code or "", rec.collector, rec.occurred_at.strftime("%Y-%m-%d %H:%M:%S"), rec.copies])
-        return file_path
-
-    def import_check_rows(self, rows: list[dict]) -> None:
-        with session_scope_serializable() as s:
-            sh = _get_open_shift(s)
-            advisory_xact_lock(s, sh.id)
-            for r in rows:
-                code = str(r.get("article","")).strip()
-                if not code: continue
-                art = _get_or_create_article(s, code)
-                when = r.get("datetime")
-                s.add(CheckHistory(shift_id=sh.id, article_id=art.id,
-                                   inspector=r.get("inspector",""), occurred_at=when))
-
-    def export_check_to_csv(self, file_path: str, shift_id: int | None = None, date_from=None, date_to=None) -> str:
-        import csv, os
-        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
-        with session_scope() as s, open(file_path, "w", encoding="utf-8-sig", newline="") as f:
-            w = csv.writer(f, delimiter=';')
-            w.writerow(["Артикул", "Проверяющий", "Дата и время"])
-            sh = s.get(Shift, shift_id) if shift_id else _get_open_shift(s)
-            stmt = (select(CheckHistory, Article.code)
-                    .join(Article, CheckHistory.article_id == Article.id, isouter=True)
-                    .where(CheckHistory.shift_id == sh.id)
-                    .order_by(CheckHistory.id.asc()))
-            if date_from: stmt = stmt.where(CheckHistory.occurred_at >= date_from)
-            if date_to:   stmt = stmt.where(CheckHistory.occurred_at < date_to)
-            for rec, code in s.execute(stmt).all():
-                w.writerow([code or "", rec.inspector, rec.occurred_at.strftime("%Y-%m-%d %H:%M:%S")])
-        return file_path
+    def import_collector_rows(self, rows: Iterable[dict], apply_to_remaining: bool = False, fine_locks: bool = True) -> None:
+        """История только дописывается; блокировки слотов нужны лишь apply_to_remaining (обновляет task_items)."""
+        def work(s):
+            create_staging_table(s, "stg_collect", "n bigserial, code text NOT NULL, collector text, occurred_at text, copies int NOT NULL")
+            copy_into(s, "stg_collect", ("code", "collector", "occurred_at", "copies"), _collect_staging_rows(rows))
+            s.execute(text("INSERT INTO articles (code) SELECT DISTINCT code FROM stg_collect ON CONFLICT (code) DO NOTHING"))
+
+            sh_id = _require_open_shift(s)
+            if apply_to_remaining or not fine_locks:
+                _import_lock(s, sh_id, "stg_collect", fine_locks)
+            s.execute(text("""
+                INSERT INTO collector_history (shift_id, article_id, collector, occurred_at, copies)
+                SELECT :sh, a.id, COALESCE(g.collector, ''), COALESCE(g.occurred_at::timestamptz, now()), g.copies
+                FROM stg_collect g JOIN articles a ON a.code = g.code
+                ORDER BY g.n
+            """), {"sh": sh_id})
+            if apply_to_remaining:
+                # строки блокируются заранее по возрастанию id, как в confirm_leases: порядок join недетерминирован
+                s.execute(text("""
+                    WITH d AS (
+                        SELECT a.id AS article_id, SUM(g.copies) AS copies
+                        FROM stg_collect g JOIN articles a ON a.code = g.code
+                        GROUP BY a.id
+                    ),
+                    cur AS (
+                        SELECT t.id, d.copies FROM task_items t JOIN d ON d.article_id = t.article_id
+                        WHERE t.shift_id = :sh
+                        ORDER BY t.id
+                        FOR UPDATE OF t
+                    )
+                    UPDATE task_items t
+                    SET remaining_copies = GREATEST(0, t.remaining_copies - cur.copies)
+                    FROM cur WHERE t.id = cur.id
+                """), {"sh": sh_id})
+
+        _run_import(work, rows, "import_collect", fine_locks)
+
+    def export_collector_to_csv(self, file_path: str, shift_id: int | None = None, date_from=None, date_to=None,
+                          all_shifts: bool = False) -> str:
+        shift_id = None if all_shifts else _read_shift_id(shift_id)
+        with read_session_scope() as s:
+            sql, params = _history_export_sql("collector_history", "NULLIF(h.collector, ''), {dt}, h.copies",
+                                              shift_id, date_from, date_to, all_shifts)
+            return export_query_to_csv(s, sql, params, file_path, ["Артикул", "Сборщик", "Дата и время", "Количество"])
+
+    def import_check_rows(self, rows: Iterable[dict], fine_locks: bool = True) -> None:
+        """История проверок только дописывается и task_items не трогает — с fine_locks блокировки не нужны."""
+        def work(s):
+            create_staging_table(s, "stg_check", "n bigserial, code text NOT NULL, inspector text, occurred_at text")
+            copy_into(s, "stg_check", ("code", "inspector", "occurred_at"), _check_staging_rows(rows))
+            s.execute(text("INSERT INTO articles (code) SELECT DISTINCT code FROM stg_check ON CONFLICT (code) DO NOTHING"))
+
+            sh_id = _require_open_shift(s)
+            if not fine_locks:
+                advisory_xact_lock(s, sh_id)
+            s.execute(text("""
+                INSERT INTO check_history (shift_id, article_id, inspector, occurred_at)
+                SELECT :sh, a.id, COALESCE(g.inspector, ''), COALESCE(g.occurred_at::timestamptz, now())
+                FROM stg_check g JOIN articles a ON a.code = g.code
+                ORDER BY g.n
+            """), {"sh": sh_id})
+
+        _run_import(work, rows, "import_check", fine_locks)
+
+    def export_check_to_csv(self, file_path: str, shift_id: int | None = None, date_from=None, date_to=None,
+                      all_shifts: bool = False) -> str:
+        shift_id = None if all_shifts else _read_shift_id(shift_id)
+        with read_session_scope() as s:
+            sql, params = _history_export_sql("check_history", "NULLIF(h.inspector, ''), {dt}",
+                                              shift_id, date_from, date_to, all_shifts)
+            return export_query_to_csv(s, sql, params, file_path, ["Артикул", "Проверяющий", "Дата и время"])
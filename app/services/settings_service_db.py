@@ -1,16 +1,25 @@
 # app/services/settings_service_db.py
+import copy
 import os
 import platform
+import threading
 from datetime import datetime
-from typing import Any, Dict
-from sqlalchemy import select
-from app.db.session import session_scope
+from typing import Any, Callable, Dict, List, Optional
+from sqlalchemy import select, update, func
+from app.db.database import session_scope
 from app.db.models import Settings  # твоя модель settings
 from app.core.constants import SUPPORTED_PRINTER_EXTS, DEFAULT_CANCEL_PASSWORD
 
 def _hostname() -> str:
     return os.environ.get("COMPUTERNAME") or platform.node()
 
+# поля настроек рабочего места, которые сохраняет UI
+SETTINGS_FIELDS = ("base_dir", "auto_save_dir", "temp_save_dir", "printer_settings",
+                   "collectors_list", "inspectors_list", "cancel_password")
+
+# задержка записи изменённых полей (серия правок — один UPDATE)
+SETTINGS_FLUSH_DELAY_S = 1.0
+
 def _default_settings() -> Dict[str, Any]:
     return {
         "base_dir": os.path.join("C:", "Путь", "К", "Папкам", "Товаров"),
@@ -23,6 +32,40 @@ def _default_settings() -> Dict[str, Any]:
     }
 
 class SettingsServiceDB:
+    """
+    Настройки рабочего места с write-behind кэшем: save_for_computer сравнивает значения с последними
+    известными из БД и помечает изменённые поля; через SETTINGS_FLUSH_DELAY_S они пишутся одним UPDATE
+    только этих колонок. Оптимистичная блокировка по updated_at: если строку успели изменить с другого
+    рабочего места, чужие изменения не затираются — конфликтующие поля берутся из БД и передаются в on_conflict.
+    """
+
+    def __init__(self, flush_delay_s: float = SETTINGS_FLUSH_DELAY_S,
+                 on_conflict: Optional[Callable[[str, List[str], Dict[str, Any]], None]] = None,
+                 log: Callable[[str], None] = print):
+        self.flush_delay_s = flush_delay_s
+        self.on_conflict = on_conflict       # (computer_name, поля, значения из БД)
+        self.log = log
+        self._lock = threading.RLock()
+        self._base: Dict[str, Dict[str, Any]] = {}    # comp -> значения, последние прочитанные/записанные
+        self._seen: Dict[str, Any] = {}                # comp -> updated_at этих значений
+        self._dirty: Dict[str, Dict[str, Any]] = {}   # comp -> изменённые, ещё не записанные поля
+        self._timer: Optional[threading.Timer] = None
+
+    def _remember(self, comp: str, row) -> Dict[str, Any]:
+        values = {
+            "base_dir": row.base_dir,
+            "auto_save_dir": row.auto_save_dir,
+            "temp_save_dir": row.temp_save_dir,
+            "printer_settings": row.printer_settings or {ext: "" for ext in SUPPORTED_PRINTER_EXTS},
+            "collectors_list": row.collectors_list or [],
+            "inspectors_list": row.inspectors_list or [],
+            "cancel_password": row.cancel_password or DEFAULT_CANCEL_PASSWORD,
+        }
+        with self._lock:
+            self._base[comp] = copy.deepcopy(values)
+            self._seen[comp] = row.updated_at
+        return values
+
     def load_for_computer(self, computer_name: str | None = None) -> Dict[str, Any]:
         comp = computer_name or _hostname()
         with session_scope() as s:
@@ -44,28 +87,120 @@ class SettingsServiceDB:
                 )
                 s.add(row)
                 s.flush()
-            return {
-                "computer_name": row.computer_name,
-                "base_dir": row.base_dir,
-                "auto_save_dir": row.auto_save_dir,
-                "temp_save_dir": row.temp_save_dir,
-                "printer_settings": row.printer_settings or {ext: "" for ext in SUPPORTED_PRINTER_EXTS},
-                "collectors_list": row.collectors_list or [],
-                "inspectors_list": row.inspectors_list or [],
-                "cancel_password": row.cancel_password or DEFAULT_CANCEL_PASSWORD,
-            }
-
-    def save_for_computer(self, data: Dict[str, Any], computer_name: str | None = None) -> None:
+            values = self._remember(comp, row)
+            with self._lock:
+                values.update(copy.deepcopy(self._dirty.get(comp, {})))  # ещё не записанные правки
+            return {"computer_name": row.computer_name, **values}
+
+    def save_for_computer(self, data: Dict[str, Any], computer_name: str | None = None, flush: bool = False) -> bool:
+        """
+        Пометить изменившиеся поля и запланировать запись (flush=True — записать сразу).
+        -> False, если относительно БД и несохранённых правок ничего не изменилось.
+        """
         comp = computer_name or _hostname()
+        if comp not in self._base:
+            self.load_for_computer(comp)
+        with self._lock:
+            base, dirty = self._base[comp], self._dirty.setdefault(comp, {})
+            changed = False
+            for key in SETTINGS_FIELDS:
+                if key not in data:
+                    continue
+                current = dirty.get(key, base.get(key))
+                if data[key] != current:
+                    changed = True
+                if data[key] != base.get(key):
+                    dirty[key] = copy.deepcopy(data[key])
+                else:
+                    dirty.pop(key, None)  # вернули прежнее значение — писать нечего
+            if not dirty:
+                self._dirty.pop(comp, None)
+        if flush:
+            self.flush()
+        elif changed:
+            self._schedule()
+        return changed
+
+    def _schedule(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.flush_delay_s, self._flush_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_in_background(self) -> None:
+        try:
+            self.flush()
+        except Exception as e:
+            self.log(f"Не удалось сохранить настройки (повтор при следующем изменении): {e}")
+
+    def flush(self) -> None:
+        """Записать изменённые поля всех рабочих мест; при ошибке БД правки остаются в кэше."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = {comp: dict(fields) for comp, fields in self._dirty.items() if fields}
+        for comp, fields in pending.items():
+            self._flush_one(comp, fields)
+
+    def _flush_one(self, comp: str, fields: Dict[str, Any]) -> None:
         with session_scope() as s:
-            row = s.execute(select(Settings).where(Settings.computer_name == comp)).scalar_one_or_none()
-            if not row:
-                row = Settings(computer_name=comp, created_at=datetime.utcnow())
-                s.add(row)
+            new_seen = s.execute(
+                update(Settings)
+                .where(Settings.computer_name == comp, Settings.updated_at.is_not_distinct_from(self._seen.get(comp)))
+                .values(**fields, updated_at=func.clock_timestamp())
+                .returning(Settings.updated_at)
+                .execution_options(synchronize_session=False)
+            ).scalar()
+            if new_seen is not None:
+                with self._lock:
+                    self._base[comp].update(copy.deepcopy(fields))
+                    self._seen[comp] = new_seen
+                    self._drop_dirty(comp, fields)
+                return
+            # строку изменили с другого рабочего места: сверяем по полям с тем, что видели мы
+            row = s.execute(select(Settings).where(Settings.computer_name == comp).with_for_update()).scalar_one_or_none()
+            if row is None:
+                return self._save_row(s, comp, fields)
+            with self._lock:
+                old_base = self._base[comp]
+            remote = self._remember(comp, row)
+            conflicts = [k for k in fields if remote[k] != old_base.get(k) and remote[k] != fields[k]]
+            keep = {k: v for k, v in fields.items() if k not in conflicts}
+            if keep:
+                for k, v in keep.items():
+                    setattr(row, k, v)
+                row.updated_at = func.clock_timestamp()
                 s.flush()
-            # минимальная валидация/заполнение
-            for key in ["base_dir", "auto_save_dir", "temp_save_dir", "printer_settings",
-                        "collectors_list", "inspectors_list", "cancel_password"]:
-                if key in data:
-                    setattr(row, key, data[key])
-            row.updated_at = datetime.utcnow()
+                s.refresh(row, ["updated_at"])
+                with self._lock:
+                    self._base[comp].update(copy.deepcopy(keep))
+                    self._seen[comp] = row.updated_at
+        with self._lock:
+            self._drop_dirty(comp, fields)
+        if conflicts and self.on_conflict:
+            self.on_conflict(comp, conflicts, {k: remote[k] for k in conflicts})
+
+    def _drop_dirty(self, comp: str, written: Dict[str, Any]) -> None:
+        # поле могли снова изменить, пока шла запись — тогда оно остаётся грязным
+        dirty = self._dirty.get(comp, {})
+        for k, v in written.items():
+            if k in dirty and dirty[k] == v:
+                del dirty[k]
+        if not dirty:
+            self._dirty.pop(comp, None)
+
+    def _save_row(self, s, comp: str, fields: Dict[str, Any]) -> None:
+        row = Settings(computer_name=comp, created_at=datetime.utcnow(), updated_at=datetime.utcnow(),
+                       **{**_default_settings(), **fields})
+        s.add(row)
+        s.flush()
+        self._remember(comp, row)
+        with self._lock:
+            self._drop_dirty(comp, fields)
+
+    def close(self) -> None:
+        """Синхронно дописать отложенные изменения (при закрытии приложения)."""
+        self.flush()
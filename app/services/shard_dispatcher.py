@@ -0,0 +1,58 @@
+import random
+import threading
+import time
+import zlib
+from typing import List, Optional
+
+from app.services.task_picker import TASK_SHARDS
+
+class ShardDispatcher:
+    """
+    Очередь смены делится на TASK_SHARDS шардов (id % TASK_SHARDS); рабочее место (или сборщик) по ключу
+    получает свой шард и выбирает позиции сначала в нём — строки, которые никто больше не блокирует.
+    Шард опустел — крадёт работу из случайных непустых чужих шардов (steal штук за выбор), и продолжает
+    в шарде, где нашлась работа; дальше — вся смена. Пустой шард перепроверяется через dry_ttl_s
+    (импорт мог добавить позиций), свой — в первую очередь, так что после пополнения место возвращается домой.
+    Состояние локально для процесса; потокобезопасно.
+    """
+
+    def __init__(self, key: str, shards: int = TASK_SHARDS, steal: int = 2, dry_ttl_s: float = 5.0):
+        self.shards_n = shards
+        self.home = zlib.crc32(key.encode("utf-8")) % shards
+        self.steal = steal
+        self.dry_ttl_s = dry_ttl_s
+        self._lock = threading.Lock()
+        self._current = self.home
+        self._dry_until = {}  # шард -> monotonic, до которого считаем его пустым
+        self._stats = {"home": 0, "stolen": 0, "fallback": 0, "dry": 0}
+
+    def shards(self) -> List[int]:
+        """Порядок шардов для очередного выбора: свой, текущий (где крадём), затем steal случайных непустых."""
+        now = time.monotonic()
+        with self._lock:
+            live = [sh for sh in range(self.shards_n) if self._dry_until.get(sh, 0.0) <= now]
+            order = [sh for sh in dict.fromkeys((self.home, self._current)) if sh in live]
+            others = [sh for sh in live if sh not in order]
+            return order + random.sample(others, min(self.steal, len(others)))
+
+    def hit(self, shard: Optional[int]) -> None:
+        """Позиция найдена в shard (None — в общей очереди смены)."""
+        with self._lock:
+            if shard is None:
+                self._stats["fallback"] += 1
+                return
+            self._dry_until.pop(shard, None)
+            self._current = shard
+            self._stats["home" if shard == self.home else "stolen"] += 1
+
+    def dry(self, shard: int) -> None:
+        """В shard нет свободных позиций."""
+        with self._lock:
+            self._dry_until[shard] = time.monotonic() + self.dry_ttl_s
+            self._stats["dry"] += 1
+            if self._current == shard:
+                self._current = self.home
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"home_shard": self.home, **self._stats}
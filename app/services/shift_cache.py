@@ -0,0 +1,137 @@
+import os
+import select as _select
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import select, text
+
+from app.db.database import engine
+from app.db.models import Shift
+
+# канал LISTEN/NOTIFY, в который пишут start_new_shift (и любое другое изменение набора открытых смен)
+SHIFT_CHANNEL = "shift_changed"
+
+def notify_shift_changed(session, shift_id: Optional[int] = None) -> None:
+    """NOTIFY уходит подписчикам при COMMIT текущей транзакции."""
+    session.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": SHIFT_CHANNEL, "payload": str(shift_id or "")})
+
+class OpenShiftCache:
+    """
+    id текущей открытой смены на процесс.
+    Пока жив LISTEN-поток, значение сбрасывается по уведомлению с любого рабочего места
+    (listen_ttl — лишь страховка); без уведомлений кэш живёт не дольше poll_ttl секунд.
+    Отдельно хранится последний известный id (last_known): его не сбрасывают ни TTL, ни обрыв LISTEN —
+    только известная смена смены (NOTIFY, start/close на этом рабочем месте) или ответ БД.
+    """
+
+    def __init__(self, listen: bool = True, listen_ttl: float = 300.0, poll_ttl: float = 5.0, retry_s: float = 10.0):
+        self.listen = listen
+        self.listen_ttl = listen_ttl
+        self.poll_ttl = poll_ttl
+        self.retry_s = retry_s
+        self._lock = threading.Lock()
+        self._shift_id: Optional[int] = None
+        self._loaded_at = 0.0
+        self._generation = 0  # растёт на каждый invalidate(): результат запроса, начатого раньше, не кэшируется
+        self._last_known: Optional[int] = None
+        self._listening = False
+        self._thread: Optional[threading.Thread] = None
+
+    # --- чтение ---
+    def get(self, session, create_if_absent: bool = False) -> Optional[int]:
+        self._ensure_listener()
+        ttl = self.listen_ttl if self._listening else self.poll_ttl
+        with self._lock:
+            sid, age, gen = self._shift_id, time.monotonic() - self._loaded_at, self._generation
+        if sid is not None and age < ttl:
+            return sid
+
+        sid = session.execute(
+            select(Shift.id).where(Shift.status == "open").order_by(Shift.started_at.desc()).limit(1)
+        ).scalar()
+        if sid is None:
+            if not create_if_absent:
+                with self._lock:
+                    if self._generation == gen:
+                        self._last_known = None
+                return None
+            sh = Shift(status="open"); session.add(sh); session.flush()
+            notify_shift_changed(session, sh.id)
+            return sh.id  # в кэш не кладём: смена ещё не закоммичена
+        with self._lock:
+            if self._generation == gen:  # иначе смену успели закрыть/сменить, пока шёл запрос
+                self._shift_id, self._loaded_at, self._last_known = sid, time.monotonic(), sid
+        return sid
+
+    def peek(self) -> Optional[int]:
+        """Закэшированный id без обращения к БД; None — кэш пуст или устарел."""
+        ttl = self.listen_ttl if self._listening else self.poll_ttl
+        with self._lock:
+            if self._shift_id is not None and time.monotonic() - self._loaded_at < ttl:
+                return self._shift_id
+        return None
+
+    def last_known(self) -> Optional[int]:
+        """Последняя известная открытая смена без обращения к БД — в т.ч. когда БД недоступна."""
+        with self._lock:
+            return self._last_known
+
+    def invalidate(self, shift_changed: bool = True) -> None:
+        """shift_changed=False — лишь перестали доверять кэшу (обрыв LISTEN): last_known остаётся."""
+        with self._lock:
+            self._shift_id = None
+            self._loaded_at = 0.0
+            self._generation += 1
+            if shift_changed:
+                self._last_known = None
+
+    @property
+    def listening(self) -> bool:
+        return self._listening
+
+    # --- LISTEN ---
+    def _ensure_listener(self) -> None:
+        if not self.listen or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen_loop, name="shift-listener", daemon=True)
+                self._thread.start()
+
+    def _listen_loop(self) -> None:
+        while True:
+            raw = None
+            try:
+                raw = engine.raw_connection()
+                raw.detach()  # собственное соединение, слот пула не занимаем
+                conn = raw.dbapi_connection
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {SHIFT_CHANNEL}")
+                self._listening = True
+                self.invalidate(shift_changed=False)  # уведомления до LISTEN могли потеряться
+                while True:
+                    if _select.select([conn], [], [], 30.0) == ([], [], []):
+                        cur.execute("SELECT 1")  # keepalive: оборванное соединение выбросит исключение
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.invalidate()
+            except Exception:
+                # уведомления недоступны — работаем на коротком TTL и пробуем переподключиться
+                self._listening = False
+                self.invalidate(shift_changed=False)
+                time.sleep(self.retry_s)
+            finally:
+                if raw is not None:
+                    try:
+                        raw.close()
+                    except Exception:
+                        pass
+
+OPEN_SHIFT = OpenShiftCache(
+    listen=os.getenv("SHIFT_CACHE_LISTEN", "1") == "1",
+    poll_ttl=float(os.getenv("SHIFT_CACHE_POLL_S", "5")),
+)
@@ -0,0 +1,151 @@
+import random
+from typing import Callable, Optional
+
+from sqlalchemy import text
+
+# условие «позицию ещё можно собирать»: остались копии сверх зарезервированных арендами (task_leases);
+# частичные индексы TaskItem в models.py построены на том же предикате
+AVAILABLE = "remaining_copies > reserved_copies"
+
+# сколько соседних позиций (по id) смотрим от случайной точки в random/weighted
+SAMPLE_WINDOW = 16
+
+# шарды очереди смены для ShardDispatcher: позиция принадлежит шарду id % TASK_SHARDS;
+# частичный индекс ix_taskitem_free_shard в models.py построен на том же выражении
+TASK_SHARDS = 16
+IN_SHARD = f"(id % {TASK_SHARDS}) = :shard"
+
+PICK_STRATEGIES = ("random", "fifo", "largest", "weighted")
+
+def start_sql(cond: str) -> str:
+    # случайная точка в [min(id), max(id)] доступных позиций; min/max берутся из индекса за O(log n)
+    return f"""(SELECT b.lo + floor(:u * (b.hi - b.lo + 1))::bigint FROM (SELECT
+    (SELECT min(id) FROM task_items WHERE shift_id = :shift_id AND {cond}) AS lo,
+    (SELECT max(id) FROM task_items WHERE shift_id = :shift_id AND {cond}) AS hi) b)"""
+
+def _sampled(order_in_window: str, cond: str) -> str:
+    # окно из SAMPLE_WINDOW позиций читается без блокировок; блокируется только выбранная строка
+    return f"""
+        SELECT t.id FROM task_items t
+        WHERE t.id = (
+            SELECT w.id FROM (
+                SELECT id, remaining_copies FROM task_items
+                WHERE shift_id = :shift_id AND {cond} AND id >= {start_sql(cond)}
+                ORDER BY id LIMIT {SAMPLE_WINDOW}
+            ) w
+            ORDER BY {order_in_window} LIMIT 1
+        ) AND {AVAILABLE}
+        FOR UPDATE SKIP LOCKED"""
+
+def _pick_sql(cond: str) -> dict:
+    return {
+        "fifo": f"""
+            SELECT id FROM task_items
+            WHERE shift_id = :shift_id AND {cond}
+            ORDER BY id LIMIT 1
+            FOR UPDATE SKIP LOCKED""",
+        "largest": f"""
+            SELECT id FROM task_items
+            WHERE shift_id = :shift_id AND {cond}
+            ORDER BY remaining_copies DESC, id LIMIT 1
+            FOR UPDATE SKIP LOCKED""",
+        "random": _sampled("random()", cond),
+        # взвешенная выборка Efraimidis–Spirakis внутри окна: ключ -ln(U)/w, берём минимальный
+        "weighted": _sampled("-ln(1.0 - random()) / remaining_copies", cond),
+    }
+
+_PICK_SQL = _pick_sql(AVAILABLE)
+_SHARD_PICK_SQL = _pick_sql(f"{AVAILABLE} AND {IN_SHARD}")
+
+def pick_sql(strategy: str, sharded: bool = False) -> str:
+    """
+    SELECT, возвращающий id одной доступной позиции смены (:shift_id, :u) под FOR UPDATE SKIP LOCKED.
+    sharded — только позиции шарда :shard. Все стратегии идут по индексам, без сортировки всей смены.
+    """
+    strategy = (strategy or "random").lower()
+    if strategy not in _PICK_SQL:
+        raise ValueError(f"strategy must be one of {PICK_STRATEGIES}")
+    return (_SHARD_PICK_SQL if sharded else _PICK_SQL)[strategy]
+
+def pick_attempts(strategy: str, shard: Optional[int] = None) -> list[tuple[str, dict]]:
+    """
+    Последовательность (sql, доп. параметры) для выбора позиции. Для random/weighted: случайная точка,
+    затем начало диапазона (окно упёрлось в конец или все его строки заняты), затем FIFO.
+    shard — то же внутри одного шарда; последней идёт FIFO по шарду, её промах значит «свободных в шарде нет».
+    """
+    strategy = (strategy or "random").lower()
+    sharded = shard is not None
+    sql = pick_sql(strategy, sharded)
+    extra = {"shard": shard} if sharded else {}
+    if strategy in ("random", "weighted"):
+        fifo = pick_sql("fifo", sharded)
+        if sharded:
+            return [(sql, {**extra, "u": random.random()}), (fifo, extra)]
+        return [(sql, {"u": random.random()}), (sql, {"u": 0.0}), (fifo, {})]
+    return [(sql, extra)]
+
+def batch_attempts(strategy: str, shard: Optional[int] = None) -> list[tuple[str, dict]]:
+    """
+    Выбор сразу нескольких позиций (TaskRepository.reserve_many): (условие WHERE, параметры) для обхода
+    доступных позиций по id от точки start_sql(cond) с переходом через начало. fifo — от начала,
+    остальные стратегии — от случайной точки.
+    """
+    u = 0.0 if (strategy or "").lower() == "fifo" else random.random()
+    if shard is None:
+        return [(AVAILABLE, {"u": u})]
+    return [(f"{AVAILABLE} AND {IN_SHARD}", {"u": u, "shard": shard})]
+
+def first_pick(strategy: str, run: Callable[[str, dict], object], dispatcher=None, attempts=pick_attempts):
+    """
+    run(sql, params) по попыткам выбора до первого не-None результата; attempts(strategy, shard=None) —
+    источник попыток (pick_attempts или batch_attempts). С dispatcher (ShardDispatcher) сначала шарды,
+    которые он предлагает (свой, затем чужие — кража работы), и только потом вся смена.
+    """
+    if dispatcher is not None:
+        for shard in dispatcher.shards():
+            for sql, extra in attempts(strategy, shard):
+                row = run(sql, extra)
+                if row is not None:
+                    dispatcher.hit(shard)
+                    return row
+            dispatcher.dry(shard)
+    for sql, extra in attempts(strategy):
+        row = run(sql, extra)
+        if row is not None:
+            if dispatcher is not None:
+                dispatcher.hit(None)
+            return row
+    return None
+
+def fill_picks(strategy: str, run: Callable[[str, dict, int], list], n: int, dispatcher=None,
+               attempts=batch_attempts) -> list:
+    """
+    Набрать n единиц по попыткам: run(sql, params, need) возвращает список выбранного (не больше need);
+    попытки идут, пока не набралось n — шарды dispatcher (шард, отдавший меньше нужного, считается пустым),
+    затем вся смена.
+    """
+    got: list = []
+    if dispatcher is not None:
+        for shard in dispatcher.shards():
+            for sql, extra in attempts(strategy, shard):
+                rows = run(sql, extra, n - len(got))
+                if rows:
+                    dispatcher.hit(shard)
+                    got += rows
+                if len(got) >= n:
+                    return got
+            dispatcher.dry(shard)
+    for sql, extra in attempts(strategy):
+        rows = run(sql, extra, n - len(got))
+        if rows:
+            if dispatcher is not None:
+                dispatcher.hit(None)
+            got += rows
+        if len(got) >= n:
+            break
+    return got
+
+def pick_task_item_id(session, shift_id: int, strategy: str = "random", dispatcher=None) -> Optional[int]:
+    """Выбрать и заблокировать позицию; None — доступных (незанятых) позиций нет."""
+    return first_pick(strategy, lambda sql, extra: session.execute(text(sql), {"shift_id": shift_id, **extra}).scalar(),
+                      dispatcher)
@@ -1,15 +1,37 @@
-from typing import List, Dict, Tuple
-import csv, os
+from typing import List, Dict, Tuple, Iterable
+import csv, os, uuid
 from datetime import datetime
-from app.services.repositories import TaskRepository
+from app.db.database import retry_idempotent
+from app.services.repositories import TaskRepository, LEASE_TTL_S
+from app.services.lease_sweeper import LeaseSweeper
+from app.services.shard_dispatcher import ShardDispatcher
 
 class TaskServiceDB:
     """Хранение задания в PostgreSQL, экспорт в CSV по требованию."""
 
     def __init__(self):
         self.repo = TaskRepository()
+        self.sweeper: LeaseSweeper | None = None
+        self.dispatcher: ShardDispatcher | None = None  # None — выбор по всей очереди смены
 
-    def merge_articles(self, existing: List[Dict[str,int]], new_items: List[Dict[str,int]], remaining: Dict[str,int]) -> Tuple[List[Dict[str,int]], Dict[str,int], int, int]:
+    def enable_sharding(self, key: str) -> ShardDispatcher:
+        """Выбирать позиции сначала в своём шарде очереди (см. ShardDispatcher); key — рабочее место или сборщик."""
+        if self.dispatcher is None:
+            self.dispatcher = ShardDispatcher(key)
+        return self.dispatcher
+
+    def enable_lease_sweeper(self, interval_s: float = 30.0, log=print) -> LeaseSweeper:
+        """Фоновая уборка истёкших аренд (см. LeaseSweeper)."""
+        if self.sweeper is None:
+            self.sweeper = LeaseSweeper(self.repo, interval_s=interval_s, log=log)
+        return self.sweeper
+
+    def close(self) -> None:
+        if self.sweeper is not None:
+            self.sweeper.close()
+            self.sweeper = None
+
+    def merge_articles(self, existing: List[Dict[str,int]], new_items: Iterable[Dict[str,int]], remaining: Dict[str,int]) -> Tuple[List[Dict[str,int]], Dict[str,int], int, int]:
         return self.repo.merge_articles(new_items)
 
     def save_task(self, task_folder_path: str, articles: List[Dict[str,int]], remaining: Dict[str,int]) -> str:
@@ -19,6 +41,9 @@ class TaskServiceDB:
     def load_task(self, _task_folder_path: str = "") -> Tuple[List[Dict[str,int]], Dict[str,int]]:
         return self.repo.get_task()
 
+    def get_task_changes(self, since_version: int = 0, known_shift_id: int | None = None) -> Dict:
+        return self.repo.get_task_changes(since_version, known_shift_id)
+
     def export_unsaved_kits(self, save_dir: str, articles: List[Dict[str,int]], remaining: Dict[str,int], auto_save: bool = True) -> str:
         os.makedirs(save_dir, exist_ok=True)
         arts, rem = self.repo.get_task()
@@ -43,14 +68,20 @@ class TaskServiceDB:
     def inc_remaining(self, article: str, by: int = 1) -> int:
         return self.repo.inc_remaining(article, by)
 
-    def start_new_shift(self) -> int:
-        return self.repo.start_new_shift()
+    def start_new_shift(self, started_by_role: str | None = None, started_by_computer: str | None = None) -> int:
+        return self.repo.start_new_shift(started_by_role, started_by_computer)
 
     def continue_open_shift(self) -> int | None:
         return self.repo.continue_open_shift()
 
+    def close_shift(self, closed_by: str | None = None, archive: bool = False) -> Dict | None:
+        return self.repo.close_shift(closed_by=closed_by, archive=archive)
+
+    def archive_shift(self, shift_id: int) -> Dict[str, int]:
+        return self.repo.archive_shift(shift_id)
+
     def pick_random_available_and_decrement(self):
-        return self.repo.pick_random_available_and_decrement()
+        return self.repo.pick_next_available_and_decrement("random", self.dispatcher)
 
     # импорт/экспорт задания
     def import_task_rows(self, rows: list[dict], mode: str = "merge") -> None:
@@ -60,4 +91,39 @@ class TaskServiceDB:
         return self.repo.export_task_to_csv(file_path)
 
     def pick_next_available_and_decrement(self, order: str = "fifo"):
-        return self.repo.pick_next_available_and_decrement(order)
+        return self.repo.pick_next_available_and_decrement(order, self.dispatcher)
+
+    def collect_one(self, collector: str, order: str = "random") -> Dict | None:
+        # op_id и время фиксируются до первой попытки: повтор после обрыва/таймаута вернёт уже записанную сборку
+        op_id, at = str(uuid.uuid4()), datetime.utcnow()
+        call = lambda: self.repo.collect_one(collector, order, at=at, op_id=op_id, dispatcher=self.dispatcher)
+        return retry_idempotent(call, "svc.collect_one")
+
+    # аренды: reserve -> печать -> confirm_lease (или release_lease при ошибке печати)
+    def reserve(self, collector: str, order: str = "random", ttl_s: float = LEASE_TTL_S) -> Dict | None:
+        op_id = str(uuid.uuid4())
+        call = lambda: self.repo.reserve(collector, order, ttl_s, op_id=op_id, dispatcher=self.dispatcher)
+        return retry_idempotent(call, "svc.reserve")
+
+    def confirm_lease(self, lease: Dict, collector: str) -> Dict | None:
+        at = datetime.utcnow()
+        return retry_idempotent(lambda: self.repo.confirm_lease(lease, collector, at=at), "svc.confirm_lease")
+
+    def release_lease(self, lease_id: int) -> bool:
+        return retry_idempotent(lambda: self.repo.release_lease(lease_id), "svc.release_lease")
+
+    # «собрать N»: пачка аренд одним запросом, подтверждение/отказ — тоже одним
+    def reserve_many(self, collector: str, n: int, order: str = "random", ttl_s: float = LEASE_TTL_S) -> List[Dict]:
+        op_id = str(uuid.uuid4())
+        call = lambda: self.repo.reserve_many(collector, n, order, ttl_s, op_id=op_id, dispatcher=self.dispatcher)
+        return retry_idempotent(call, "svc.reserve_many")
+
+    def confirm_leases(self, leases: List[Dict], collector: str) -> Dict:
+        at = datetime.utcnow()
+        return retry_idempotent(lambda: self.repo.confirm_leases(leases, collector, at=at), "svc.confirm_leases")
+
+    def release_leases(self, lease_ids: List[int]) -> int:
+        return retry_idempotent(lambda: self.repo.release_leases(lease_ids), "svc.release_leases")
+
+    def undo_collect(self, history_id: int) -> int | None:
+        return retry_idempotent(lambda: self.repo.undo_collect(history_id), "svc.undo_collect")
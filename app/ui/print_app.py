@@ -9,6 +9,7 @@ from tkinter import ttk, messagebox, filedialog, simpledialog
 
 # DB init
 from app.db.init_db import init_db
+from app.db.database import pool_stats, read_stats, tx_stats
 
 # Сервисы
 from app.core.constants import SUPPORTED_PRINTER_EXTS, DEFAULT_CANCEL_PASSWORD
@@ -17,10 +18,13 @@ from app.services.io_service import IOService
 from app.services.printer_service import PrinterService
 from app.services.task_service_db import TaskServiceDB as TaskService
 from app.services.history_service_db import HistoryServiceDB as HistoryService
+from app.services.repositories import HISTORY_PAGE_SIZE
 from app.services.label_service import LabelService
 from app.services.import_export_service_db import ImportExportServiceDB
 
 ROLES = ("Админ", "Начальник смены", "Сборщик", "Проверяющий")
+# верхняя граница «Собрать N» за одно нажатие
+COLLECT_MAX_KITS = 20
 
 def ask_role_dialog(root) -> str | None:
     import tkinter as tk
@@ -68,7 +72,7 @@ class PrintApp:
         self.computer_name = os.environ.get("COMPUTERNAME") or platform.node()
 
         # --- сервисы ---
-        self.settings_srv = SettingsService()
+        self.settings_srv = SettingsService(on_conflict=self._on_settings_conflict, log=self.log)
         self.io_srv = IOService()
         self.printer_srv = PrinterService()
         self.task_srv = TaskService()
@@ -100,11 +104,37 @@ class PrintApp:
             # чтобы в UI и логах было понятно, что печать — эмуляция
             self.log("Эмуляция печати включена (PRINT_EMULATE=1). Файлы копируются в temp_save_dir/_printed/<date>")
 
+        if os.getenv("HISTORY_JOURNAL", "0") == "1":
+            # события истории сначала на локальный диск, в БД — фоновым потоком
+            journal = self.hist_srv.enable_journal(self.temp_save_dir.get(), log=self.log)
+            self.log(f"Локальный журнал истории включён (HISTORY_JOURNAL=1): {journal.path}, в очереди: {journal.pending()}")
+        elif int(os.getenv("HISTORY_COALESCE_MS", "0") or 0) > 0:
+            # всплеск проверок — несколько COMMIT вместо одного на событие
+            delay_ms = int(os.getenv("HISTORY_COALESCE_MS"))
+            self.hist_srv.enable_coalescing(max_delay_s=delay_ms / 1000.0, log=self.log)
+            self.log(f"Пакетная запись истории включена (HISTORY_COALESCE_MS={delay_ms})")
+
+        if os.getenv("TASK_SHARDING", "0") == "1":
+            # свой шард очереди на рабочее место: выборы разных мест не задевают одни и те же строки
+            disp = self.task_srv.enable_sharding(self.computer_name)
+            self.log(f"Шардирование очереди сборки включено (TASK_SHARDING=1), шард места: {disp.home}")
+
+        sweep_s = float(os.getenv("TASK_LEASE_SWEEP_S", "30") or 0)
+        if sweep_s > 0:
+            # аренды упавших посреди печати рабочих мест возвращаются в очередь
+            self.task_srv.enable_lease_sweeper(interval_s=sweep_s, log=self.log)
+
         # --- состояние ---
         self.articles_data = []             # [{"article": str, "copies": int}, ...] (для UI)
         self.remaining_copies = {}          # {article: left}
+        self.task_shift_id = None           # смена, к которой относится кэш задания
+        self.task_version = 0               # водяной знак get_task_changes
+        self._article_rows = {}             # {article: строка articles_data}
+        self._tree_items = {}               # {article: iid в self.tree}
         self.collector_data = []            # [{"article","collector","datetime","copies"}] (кэш UI)
         self.check_history = []             # [{"article","inspector","datetime"}] (кэш UI)
+        self._history_has_more = {"collect": False, "check": False}  # есть ли более старые страницы в БД
+        self._history_loading = set()
         self.last_collector_time = {}
         self.collector_timeout = 120
         self.shift_started = False
@@ -171,7 +201,10 @@ class PrintApp:
         self.continue_shift_button = ttk.Button(shift_frame, text="Продолжить смену", command=self.continue_shift)
         self.continue_shift_button.grid(row=0, column=1, padx=5)
 
-        ttk.Label(shift_frame, textvariable=self.shift_button_var).grid(row=0, column=2, padx=10)
+        self.close_shift_button = ttk.Button(shift_frame, text="Закрыть смену", command=self.close_shift, state="disabled")
+        self.close_shift_button.grid(row=0, column=2, padx=5)
+
+        ttk.Label(shift_frame, textvariable=self.shift_button_var).grid(row=0, column=3, padx=10)
 
         ttk.Label(self.assembly_frame, text="Ручной ввод артикула:", font=('Arial', 10, 'bold')).grid(row=1, column=0, sticky="w", pady=5)
         # self.entry = ttk.Entry(self.assembly_frame, width=30)
@@ -259,6 +292,11 @@ class PrintApp:
 
         ttk.Label(self.task_frame, text="Печать следующего артикула (все файлы, кроме .btw), по 1 копии").grid(row=2, column=0, columnspan=2, pady=5)
 
+        ttk.Label(self.task_frame, text="Комплектов за раз:").grid(row=3, column=0, sticky="w", pady=5)
+        self.collect_n_var = tk.StringVar(value="1")
+        ttk.Spinbox(self.task_frame, from_=1, to=COLLECT_MAX_KITS, textvariable=self.collect_n_var, width=5).grid(
+            row=3, column=1, sticky="w", pady=5, padx=5)
+
         self.collect_button = ttk.Button(self.task_frame, text="Собрать", command=self.start_task_thread, state="disabled")
         self.collect_button.grid(row=5, column=0, padx=5, pady=20)
 
@@ -277,7 +315,7 @@ class PrintApp:
         self.collector_tree.grid(row=9, column=0, columnspan=2, pady=5, sticky="nsew")
         ct_scroll = ttk.Scrollbar(self.task_frame, orient="vertical", command=self.collector_tree.yview)
         ct_scroll.grid(row=9, column=2, sticky="ns", pady=5)
-        self.collector_tree.configure(yscrollcommand=ct_scroll.set)
+        self.collector_tree.configure(yscrollcommand=lambda f, l: self._on_history_scroll("collect", ct_scroll, f, l))
 
         ctrl = ttk.Frame(self.task_frame); ctrl.grid(row=10, column=0, columnspan=2, pady=10)
         ttk.Button(ctrl, text="Сохранить историю сборки", command=self.save_collector_data_to_file).grid(row=0, column=0, padx=5)
@@ -338,7 +376,7 @@ class PrintApp:
         self.check_tree.grid(row=6, column=0, columnspan=2, pady=5, sticky="nsew")
         sc = ttk.Scrollbar(self.check_frame, orient="vertical", command=self.check_tree.yview)
         sc.grid(row=6, column=2, sticky="ns", pady=5)
-        self.check_tree.configure(yscrollcommand=sc.set)
+        self.check_tree.configure(yscrollcommand=lambda f, l: self._on_history_scroll("check", sc, f, l))
 
         hist_ctrl = ttk.Frame(self.check_frame); hist_ctrl.grid(row=7, column=0, columnspan=2, pady=10)
         ttk.Button(hist_ctrl, text="Сохранить историю", command=self.save_check_history_to_file).grid(row=0, column=0, padx=5)
@@ -443,12 +481,52 @@ class PrintApp:
         self.log(f"Найдено принтеров: {len(printers)}")
 
     def _load_histories(self):
-        self.check_history = self.hist_srv.load_check_history("")
-        self.collector_data = self.hist_srv.load_collector_data("")
-        self.update_check_history_table()
-        self.update_collector_table()
+        # только последняя страница; более старые записи подгружаются при прокрутке вверх
+        self._reload_history("check")
+        self._reload_history("collect")
         self.log(f"Загружено историй: сборка={len(self.collector_data)}, проверка={len(self.check_history)}")
 
+    def _reload_history(self, kind: str):
+        if kind == "collect":
+            self.collector_data = list(reversed(self.hist_srv.load_collector_page()))
+            self._history_has_more[kind] = len(self.collector_data) >= HISTORY_PAGE_SIZE
+            self.update_collector_table()
+        else:
+            self.check_history = list(reversed(self.hist_srv.load_check_page()))
+            self._history_has_more[kind] = len(self.check_history) >= HISTORY_PAGE_SIZE
+            self.update_check_history_table()
+
+    def _on_history_scroll(self, kind: str, scrollbar, first, last):
+        scrollbar.set(first, last)
+        if float(first) <= 0.0 and self._history_has_more[kind] and kind not in self._history_loading:
+            self._history_loading.add(kind)
+            self.root.after_idle(lambda: self._load_more_history(kind))
+
+    def _load_more_history(self, kind: str):
+        try:
+            if kind == "collect":
+                data, tree, loader = self.collector_data, self.collector_tree, self.hist_srv.load_collector_page
+                values = lambda r: (r['article'], r['collector'], r['datetime'], r['copies'])
+            else:
+                data, tree, loader = self.check_history, self.check_tree, self.hist_srv.load_check_page
+                values = lambda r: (r['article'], r['inspector'], r['datetime'])
+            oldest = next((r["id"] for r in data if r.get("id")), None)
+            page = loader(oldest) if oldest is not None else []
+            if len(page) < HISTORY_PAGE_SIZE:
+                self._history_has_more[kind] = False
+            if not page:
+                return
+            rows = list(reversed(page))
+            data[:0] = rows
+            for i, row in enumerate(rows):
+                tree.insert('', i, values=values(row))
+            # оставляем на экране те же строки, иначе прокрутка в самом верху сразу запросит следующую страницу
+            tree.yview_moveto(len(rows) / len(data))
+        except Exception as e:
+            self.log(f"Ошибка подгрузки истории: {e}")
+        finally:
+            self._history_loading.discard(kind)
+
     def update_article_lists(self):
         values = [row["article"] for row in self.articles_data]
         if hasattr(self, "entry"):
@@ -467,8 +545,27 @@ class PrintApp:
             "printer_settings": self.printer_settings,
             "cancel_password": self.cancel_password,
         }
-        self.settings_srv.save_for_computer(data, computer_name=self.computer_name)
-        self.log(f"Настройки сохранены для ПК: {self.computer_name}.")
+        # пишутся только изменённые поля, с задержкой; без изменений — ни одного запроса к БД
+        if self.settings_srv.save_for_computer(data, computer_name=self.computer_name):
+            self.log(f"Настройки сохранены для ПК: {self.computer_name}.")
+
+    def _on_settings_conflict(self, computer_name: str, fields: list, values: dict):
+        # вызывается из фонового потока записи: применяем значения из БД в UI-потоке
+        def apply():
+            if "collectors_list" in values:
+                self.collectors_list = list(values["collectors_list"]); self.update_collectors_listbox()
+            if "inspectors_list" in values:
+                self.inspectors_list = list(values["inspectors_list"]); self.update_inspectors_listbox()
+            for key in ("base_dir", "auto_save_dir", "temp_save_dir"):
+                if key in values:
+                    getattr(self, key).set(values[key])
+            if "cancel_password" in values:
+                self.cancel_password = values["cancel_password"]
+            if "printer_settings" in values:
+                for ext, var in self.printer_vars.items():
+                    var.set(values["printer_settings"].get(ext, ""))
+            self.log(f"Настройки ПК {computer_name} изменены с другого рабочего места, взяты значения из БД: {', '.join(fields)}")
+        self.root.after(0, apply)
 
     def apply_role_permissions(self):
         can_start_shift = self.current_role in ("Админ", "Начальник смены")
@@ -477,6 +574,7 @@ class PrintApp:
 
         # Кнопки смены
         self.start_shift_button.config(state="normal" if can_start_shift else "disabled")
+        self.close_shift_button.config(state="normal" if can_start_shift and self.shift_started else "disabled")
         self.continue_shift_button.config(state="normal")  # любой может подключиться к открытой смене
 
         # Кнопки действий (зависят от открытой смены)
@@ -504,10 +602,8 @@ class PrintApp:
             return
         try:
             # загрузка задания через сервис
-            self.articles_data, self.remaining_copies = self.task_srv.load_task("")
-            self._rebuild_assembly_table()
+            self._sync_task(full=True)
             self._update_task_info()
-            self.update_article_lists()
             self.log("Артикулы успешно загружены из БД")
             messagebox.showinfo("Успех", "Задание загружено из базы данных.")
         except Exception as e:
@@ -522,7 +618,7 @@ class PrintApp:
         if not p:
             messagebox.showerror("Ошибка", "Выберите файл!"); return
         try:
-            new_data = self.io_srv.load_any(p)
+            new_data = self.io_srv.iter_any(p)  # CSV/TXT потоком, merge_articles пишет пачками
             self.articles_data, self.remaining_copies, added, updated = self.task_srv.merge_articles(self.articles_data, new_data, self.remaining_copies)
             self._rebuild_assembly_table()
             self._update_task_info()
@@ -580,8 +676,7 @@ class PrintApp:
     def clear_articles_list(self):
         self.articles_data = []
         self.remaining_copies = {}
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        self._rebuild_assembly_table()
         self._update_task_info()
         self.update_article_lists()
         self.log("Список артикулов очищен (локально). Задание в БД не тронуто.")
@@ -589,8 +684,43 @@ class PrintApp:
     def _rebuild_assembly_table(self):
         for item in self.tree.get_children():
             self.tree.delete(item)
-        for row in self.articles_data:
-            self.tree.insert('', 'end', values=(row['article'], row['copies'], 'Ожидание'))
+        self._article_rows = {row['article']: row for row in self.articles_data}
+        self._tree_items = {row['article']: self.tree.insert('', 'end', values=(row['article'], row['copies'], 'Ожидание'))
+                            for row in self.articles_data}
+
+    def _sync_task(self, full: bool = False):
+        """Применить к articles_data/remaining_copies/таблице только изменения задания с прошлой синхронизации."""
+        ch = self.task_srv.get_task_changes(0 if full else self.task_version, self.task_shift_id)
+        if ch["full"]:
+            self.articles_data = [{"article": it["article"], "copies": it["copies"]} for it in ch["items"]]
+            self.remaining_copies = {it["article"]: it["remaining"] for it in ch["items"]}
+            self._rebuild_assembly_table()
+        else:
+            # удалённые и затем снова добавленные позиции придут в items — их не удаляем
+            gone = set(ch["deleted"]) - {it["article"] for it in ch["items"]}
+            if gone:
+                self.articles_data = [r for r in self.articles_data if r["article"] not in gone]
+                for code in gone:
+                    self.remaining_copies.pop(code, None)
+                    self._article_rows.pop(code, None)
+                    iid = self._tree_items.pop(code, None)
+                    if iid:
+                        self.tree.delete(iid)
+            for it in ch["items"]:
+                code = it["article"]
+                row = self._article_rows.get(code)
+                if row is None:
+                    row = {"article": code, "copies": it["copies"]}
+                    self.articles_data.append(row)
+                    self._article_rows[code] = row
+                    self._tree_items[code] = self.tree.insert('', 'end', values=(code, it["copies"], 'Ожидание'))
+                elif row["copies"] != it["copies"]:
+                    row["copies"] = it["copies"]
+                    if code in self._tree_items:
+                        self.tree.set(self._tree_items[code], 'copies', it["copies"])
+                self.remaining_copies[code] = it["remaining"]
+        self.task_shift_id, self.task_version = ch["shift_id"], ch["version"]
+        self.update_article_lists()
 
     # ------------- Вкладка Задание -------------
     def update_collector_button_state(self, event=None):
@@ -617,7 +747,7 @@ class PrintApp:
         t = threading.Thread(target=self._execute_task, args=(name,), daemon=True)
         t.start()
 
-    def _execute_task(self):
+    def _execute_task(self, collector_name: str = ""):
         if not self.shift_started:
             messagebox.showwarning("Внимание", "Смена не начата. Попросите начальника начать смену.");
             return
@@ -628,62 +758,89 @@ class PrintApp:
         self.printing_in_progress = True
         self.task_status_var.set("Выполнение задания...")
 
+        collector = collector_name or self.computer_name
+        n = self._collect_count()
         try:
-            # случайный выбор и уменьшение remaining с блокировкой
-            pick = self.task_srv.pick_random_available_and_decrement()
+            # аренды копий (n — одним запросом): remaining и история не меняются до подтверждения
+            if n > 1:
+                leases = self.task_srv.reserve_many(collector, n)
+            else:
+                lease = self.task_srv.reserve(collector)
+                leases = [lease] if lease else []
         except Exception as e:
             self.task_status_var.set("Ошибка БД при выборе задания")
             self.log(f"Ошибка выбора задания: {e}")
             self.printing_in_progress = False;
             return
 
-        if not pick:
+        if not leases:
             self.task_status_var.set("Все артикула отпечатаны!")
             self.log("Все артикула отпечатаны");
             self.printing_in_progress = False;
             return
 
-        article, left = pick  # left ∈ {0,1} после уменьшения
-        self.log(f"Сборка: выбран '{article}' (осталось после уменьшения: {left})")
-
-        ok = self._print_article_task(article)  # печать всех файлов кроме .btw, ровно 1 раз
-        if not ok:
-            # компенсируем уменьшение (вернуть 1)
+        self.log(f"Сборка: выбрано {len(leases)}: " + ", ".join(l["article"] for l in leases))
+        printed = []
+        for i, lease in enumerate(leases):
+            if not self._print_article_task(lease["article"]):  # печать всех файлов кроме .btw, ровно 1 раз
+                # принтер сбоит — остаток пачки не печатаем, аренды снимаем (не получилось — освободятся по сроку)
+                failed = leases[i:]
+                try:
+                    self.task_srv.release_leases([l["lease_id"] for l in failed])
+                except Exception as e:
+                    self.log(f"Не удалось снять аренды (освободятся по сроку): {e}")
+                self.task_status_var.set(f"Ошибка печати: {lease['article']}")
+                break
+            printed.append(lease)
+
+        items, remaining_total = [], None
+        if printed:
             try:
-                self.task_srv.inc_remaining(article, by=1)
+                # списание копий и запись истории — одна транзакция на всю пачку
+                res = self.task_srv.confirm_leases(printed, collector)
+                items, remaining_total = res["items"], res["remaining_total"]
             except Exception as e:
-                self.log(f"Ошибка компенсации remaining для '{article}': {e}")
-            self.task_status_var.set(f"Ошибка печати: {article}")
-            messagebox.showerror("Ошибка", "Проверьте принтер!")
-            self.printing_in_progress = False;
-            return
+                self.log(f"Ошибка подтверждения сборки: {e}")
+            if len(items) < len(printed):
+                self.log(f"Напечатано, но не записано в БД: {len(printed) - len(items)} из {len(printed)}")
 
-        # история: записываем действие от имени ПК (так как имени сборщика нет)
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.collector_data.append({'collector': self.computer_name, 'article': article, 'datetime': now, 'copies': 1})
-        self.hist_srv.save_collector_data("", [self.collector_data[-1]])
+        # история уже записана в БД тем же запросом — обновляем только кэш UI
+        for it in items:
+            self.collector_data.append({'id': it["history_id"], 'collector': collector,
+                                        'article': it["article"], 'datetime': it["datetime"], 'copies': 1})
+            self.remaining_copies[it["article"]] = it["left"]
 
         # обновим UI
-        self.articles_data, self.remaining_copies = self.task_srv.load_task("")
-        self.update_collector_table()
-        self.task_status_var.set(f"Отпечатано: {article}")
-        self._update_task_info()
+        if items:
+            self.update_collector_table()
+            self._update_task_info(remaining_total)
+        if len(printed) < len(leases):
+            messagebox.showerror("Ошибка", "Проверьте принтер!")
+        elif len(items) < len(printed):
+            self.task_status_var.set(f"Не записано: {', '.join(l['article'] for l in printed)}")
+        else:
+            self.task_status_var.set(f"Отпечатано: {', '.join(it['article'] for it in items)}")
         self.printing_in_progress = False
 
+    def _collect_count(self) -> int:
+        try:
+            return max(1, min(COLLECT_MAX_KITS, int(self.collect_n_var.get())))
+        except (tk.TclError, ValueError):
+            return 1
+
     def cancel_last_task(self):
         if not self.collector_data:
             messagebox.showinfo("Информация", "Нет действий для отмены"); return
         if not self._ask_password():
             messagebox.showerror("Ошибка", "Неверный пароль!"); return
-        last_db = self.hist_srv.cancel_last_collect()
+        # удаление записи и возврат копий в задание — одна транзакция
+        last_db = self.hist_srv.cancel_last_collect(restore_remaining=True)
         if not last_db:
             messagebox.showinfo("Информация", "Нет действий для отмены"); return
         art = last_db['article']
-        self.task_srv.inc_remaining(art, by=int(last_db.get("copies",1)))
         self.collector_data.pop()
+        self._sync_task()
         self.update_collector_table(); self._update_task_info()
-        self.update_article_lists()
-        self.articles_data, self.remaining_copies = self.task_srv.load_task("")
         self.log(f"Отменено последнее действие: {last_db['collector']} — {art}")
         messagebox.showinfo("Успех", f"Отменено действие для артикула '{art}'")
 
@@ -692,6 +849,9 @@ class PrintApp:
             self.collector_tree.delete(i)
         for row in self.collector_data:
             self.collector_tree.insert('', 'end', values=(row['article'], row['collector'], row['datetime'], row['copies']))
+        children = self.collector_tree.get_children()
+        if children:
+            self.collector_tree.see(children[-1])  # новые внизу; заодно не попадаем в «верх» с подгрузкой
 
     def save_collector_data_to_file(self):
         if not self.collector_data:
@@ -780,6 +940,9 @@ class PrintApp:
             self.check_tree.delete(i)
         for row in self.check_history:
             self.check_tree.insert('', 'end', values=(row['article'], row['inspector'], row['datetime']))
+        children = self.check_tree.get_children()
+        if children:
+            self.check_tree.see(children[-1])
 
     def save_check_history_to_file(self):
         if not self.check_history:
@@ -901,8 +1064,7 @@ class PrintApp:
         try:
             # НЕ уменьшаем remaining по умолчанию; если нужно — передайте True
             self.imp_exp_srv.import_collector_from_csv(p, apply_to_remaining=False)
-            self.collector_data = self.hist_srv.load_collector_data("")
-            self.update_collector_table()
+            self._reload_history("collect")
             self.log(f"Импорт истории сборки: {p}")
             messagebox.showinfo("Успех", "Импорт истории сборки завершён.")
         except Exception as e:
@@ -926,8 +1088,7 @@ class PrintApp:
         if not p: return
         try:
             self.imp_exp_srv.import_check_from_csv(p)
-            self.check_history = self.hist_srv.load_check_history("")
-            self.update_check_history_table()
+            self._reload_history("check")
             self.log(f"Импорт истории проверок: {p}")
             messagebox.showinfo("Успех", "Импорт истории проверок завершён.")
         except Exception as e:
@@ -1048,8 +1209,7 @@ class PrintApp:
             return
         if messagebox.askyesno("Начать смену", "Начать новую смену для всех? Текущие UI-данные будут очищены."):
             self.task_srv.start_new_shift(started_by_role=self.current_role, started_by_computer=self.computer_name)
-            self.articles_data, self.remaining_copies = self.task_srv.load_task("")
-            self._rebuild_assembly_table();
+            self._sync_task(full=True)
             self._update_task_info()
             self.shift_started = True
             self.shift_button_var.set(f"Смена начата ({self.current_role})")
@@ -1059,8 +1219,7 @@ class PrintApp:
     def continue_shift(self):
         sid = self.task_srv.continue_open_shift()  # ищем открытую смену без привязки к имени
         if sid:
-            self.articles_data, self.remaining_copies = self.task_srv.load_task("")
-            self._rebuild_assembly_table();
+            self._sync_task(full=True)
             self._update_task_info()
             self.shift_started = True
             self.shift_button_var.set("Смена подключена")
@@ -1069,6 +1228,38 @@ class PrintApp:
         else:
             messagebox.showwarning("Внимание", "Нет открытой смены. Попросите начальника смены её начать.")
 
+    def close_shift(self):
+        if self.current_role not in ("Админ", "Начальник смены"):
+            messagebox.showwarning("Доступ запрещен", "Только начальник смены или админ могут закрывать смену.")
+            return
+        if not messagebox.askyesno("Закрыть смену", "Закрыть текущую смену для всех? Её задание и история уйдут в архив."):
+            return
+        self.shift_started = False
+        self.shift_button_var.set("Смена закрывается...")
+        self.apply_role_permissions()
+        threading.Thread(target=self._close_shift_worker, daemon=True).start()
+
+    def _close_shift_worker(self):
+        try:
+            # итоги и закрытие — сразу; перенос строк в архив — пачками, может занять время
+            summary = self.task_srv.close_shift(closed_by=self.computer_name)
+        except Exception as e:
+            self.log(f"Ошибка закрытия смены: {e}")
+            self.shift_button_var.set("Ошибка закрытия смены")
+            return
+        self.shift_button_var.set("Смена закрыта")
+        if summary:
+            self.log(f"Смена {summary['shift_id']} закрыта: собрано {summary['collected_copies']} из {summary['total_copies']}, "
+                     f"осталось {summary['remaining_copies']}, проверок {summary['check_count']}")
+        else:
+            self.log("Открытой смены нет")
+            return
+        try:
+            moved = self.task_srv.archive_shift(summary["shift_id"])
+            self.log(f"Смена {summary['shift_id']} перенесена в архив: " + ", ".join(f"{t}={n}" for t, n in moved.items()))
+        except Exception as e:
+            self.log(f"Ошибка переноса смены в архив (доделает scripts/archive_shifts.py): {e}")
+
     def _update_buttons_state(self):
         if self.shift_started:
             self.select_file_button.config(state="normal")
@@ -1082,14 +1273,14 @@ class PrintApp:
             self.collect_button.config(state="disabled")
 
     def force_load_task(self):
-        self.articles_data, self.remaining_copies = self.task_srv.load_task("")
-        self._rebuild_assembly_table(); self._update_task_info()
-        self.update_article_lists()
+        self._sync_task(full=True)  # полный снимок: после локальной очистки инкремент вернул бы лишь изменённые строки
+        self._update_task_info()
         self.log("Задание успешно обновлено из БД!"); return True
 
-    def _update_task_info(self):
+    def _update_task_info(self, remaining_total: int | None = None):
         total_articles = len(self.articles_data)
-        remaining_total = self.task_srv.remaining_total(self.articles_data, self.remaining_copies)
+        if remaining_total is None:
+            remaining_total = self.task_srv.remaining_total(self.articles_data, self.remaining_copies)
         self.task_info_var.set(f"Загружено артикулов: {total_articles}, Осталось копий: {remaining_total} (БД)")
 
     # ------------- Истории/логи/закрытие -------------
@@ -1122,6 +1313,13 @@ class PrintApp:
             if path:
                 self.log(f"Автосохранены несобранные комплекты: {path}")
             self.save_settings()
+            self.settings_srv.close()
+            self.hist_srv.close()
+            self.task_srv.close()
+            self.log(f"Пул соединений БД: {pool_stats()}; чтения: {read_stats()}")
+            self.log(f"Повторы транзакций: {tx_stats()}")
+            if self.task_srv.dispatcher is not None:
+                self.log(f"Шарды очереди сборки: {self.task_srv.dispatcher.stats()}")
         finally:
             self.root.destroy()
 
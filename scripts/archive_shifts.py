@@ -0,0 +1,27 @@
+"""
+Перенос строк закрытых смен (задание, история сборки и проверок) в *_archive; выгрузки читают и архив.
+Нужен для смен, закрытых без архивации (например, start_new_shift закрывает прежнюю смену только с итогами)
+или если архивация прервалась. Безопасно запускать во время работы: пачки короткие.
+
+Запуск: python scripts/archive_shifts.py [--batch 5000]
+"""
+
+import argparse
+
+from app.db.init_db import init_db
+from app.services.repositories import TaskRepository, ARCHIVE_BATCH_ROWS
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--batch", type=int, default=ARCHIVE_BATCH_ROWS, help="строк за одну транзакцию переноса")
+    args = ap.parse_args()
+
+    init_db()
+    done = TaskRepository().archive_closed_shifts(batch_rows=args.batch)
+    for sh_id, moved in done.items():
+        print(f"смена {sh_id}: " + ", ".join(f"{t}={n}" for t, n in moved.items()))
+    if not done:
+        print("нет закрытых смен для архивации")
+
+if __name__ == "__main__":
+    main()
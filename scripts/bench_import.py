@@ -0,0 +1,67 @@
+"""
+Бенчмарк импорта задания: построчный путь (как был до staging-импорта) против COPY + set-based слияния.
+
+ВНИМАНИЕ: запускать только на тестовой БД — скрипт открывает новые смены и заливает в них
+синтетические артикулы BENCH-*.
+
+Запуск: python scripts/bench_import.py [кол-во строк]
+"""
+
+import sys, time
+
+from sqlalchemy import select
+
+from app.db.init_db import init_db
+from app.db.database import session_scope_serializable, advisory_xact_lock
+from app.db.models import Article, TaskItem
+from app.services.repositories import TaskRepository, _open_shift_id
+
+def make_rows(n: int) -> list[dict]:
+    # ~10% повторов кода, как в реальных выгрузках
+    return [{"article": f"BENCH-{i % max(1, n - n // 10):06d}", "total": 2, "remaining": 2} for i in range(n)]
+
+def import_task_rows_per_row(rows: list[dict]) -> None:
+    """Прежняя реализация TaskRepository.import_task_rows (mode="merge")."""
+    with session_scope_serializable() as s:
+        sh_id = _open_shift_id(s)
+        advisory_xact_lock(s, sh_id)
+        for r in rows:
+            code = str(r["article"]).strip()
+            if not code:
+                continue
+            total = int(r.get("total") or r.get("copies") or 1)
+            remaining = r.get("remaining")
+            remaining = total if remaining is None else int(remaining)
+            art = s.execute(select(Article).where(Article.code == code)).scalar_one_or_none()
+            if not art:
+                art = Article(code=code); s.add(art); s.flush()
+            ti = s.execute(
+                select(TaskItem).where(TaskItem.shift_id == sh_id, TaskItem.article_id == art.id).with_for_update()
+            ).scalar_one_or_none()
+            if ti:
+                ti.total_copies += total
+                ti.remaining_copies += remaining
+            else:
+                s.add(TaskItem(shift_id=sh_id, article_id=art.id, total_copies=total, remaining_copies=remaining))
+                s.flush()
+
+def bench(label: str, fn, rows: list[dict]) -> float:
+    repo = TaskRepository()
+    repo.start_new_shift(started_by_role="bench", started_by_computer="bench")
+    t0 = time.perf_counter()
+    fn(rows)
+    dt = time.perf_counter() - t0
+    _, remaining = repo.get_task()
+    print(f"{label:<12} {len(rows):>7} строк  {dt:8.2f} c  ({len(rows) / dt:,.0f} строк/с), позиций: {len(remaining)}")
+    return dt
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    init_db()
+    rows = make_rows(n)
+    t_row = bench("per-row", import_task_rows_per_row, rows)
+    t_copy = bench("copy", TaskRepository().import_task_rows, rows)
+    print(f"ускорение: x{t_row / t_copy:.1f}")
+
+if __name__ == "__main__":
+    main()
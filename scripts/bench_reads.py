@@ -0,0 +1,72 @@
+"""
+Бенчмарк чтения смены: ORM-путь (как был до fast_reads: сущности + joinedload) против Core fast path.
+
+ВНИМАНИЕ: запускать только на тестовой БД — скрипт открывает новую смену и заливает в неё
+синтетические артикулы BENCH-* и историю сборки.
+
+Запуск: python scripts/bench_reads.py [кол-во строк] [повторов]
+"""
+
+import sys, time
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from app.db.init_db import init_db
+from app.db.database import session_scope
+from app.db.models import Article, TaskItem, CollectorHistory
+from app.services.repositories import TaskRepository, HistoryRepository, _open_shift_id
+from app.services.fast_reads import task_rows, collect_rows
+
+def orm_task(s, sh_id):
+    items = s.execute(select(TaskItem).options(joinedload(TaskItem.article)).where(TaskItem.shift_id == sh_id)).scalars().all()
+    return [{"article": it.article.code, "copies": it.total_copies} for it in items], \
+           {it.article.code: it.remaining_copies for it in items}
+
+def fast_task(s, sh_id):
+    rows = task_rows(s, sh_id)
+    return [{"article": code, "copies": total} for code, _, total, _ in rows], \
+           {code: left for code, _, _, left in rows}
+
+def orm_collect(s, sh_id):
+    rows = s.execute(
+        select(CollectorHistory, Article.code)
+        .join(Article, CollectorHistory.article_id == Article.id, isouter=True)
+        .where(CollectorHistory.shift_id == sh_id).order_by(CollectorHistory.id.asc())
+    ).all()
+    return [{"article": code or "", "collector": rec.collector,
+             "datetime": rec.occurred_at.strftime("%Y-%m-%d %H:%M:%S"), "copies": rec.copies} for rec, code in rows]
+
+def fast_collect(s, sh_id):
+    return [{"article": code or "", "collector": collector,
+             "datetime": when.strftime("%Y-%m-%d %H:%M:%S"), "copies": copies}
+            for _, code, collector, copies, when in collect_rows(s, sh_id)]
+
+def bench(label: str, fn, sh_id: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        with session_scope() as s:
+            t0 = time.perf_counter()
+            n = len(fn(s, sh_id))
+            best = min(best, time.perf_counter() - t0)
+    print(f"{label:<14} {n:>8} строк  лучшее из {repeat}: {best * 1000:8.1f} мс")
+    return best
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    init_db()
+    repo = TaskRepository()
+    repo.start_new_shift(started_by_role="bench", started_by_computer="bench")
+    repo.import_task_rows([{"article": f"BENCH-{i:07d}", "total": 3, "remaining": 3} for i in range(n)])
+    HistoryRepository().import_collector_rows([{"article": f"BENCH-{i:07d}", "collector": "bench", "copies": 1} for i in range(n)])
+    with session_scope() as s:
+        sh_id = _open_shift_id(s)
+
+    for name, orm_fn, fast_fn in (("task", orm_task, fast_task), ("collect", orm_collect, fast_collect)):
+        t_orm = bench(f"{name}/orm", orm_fn, sh_id, repeat)
+        t_fast = bench(f"{name}/fast", fast_fn, sh_id, repeat)
+        print(f"{name}: ускорение x{t_orm / t_fast:.1f}")
+
+if __name__ == "__main__":
+    main()
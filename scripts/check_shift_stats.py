@@ -0,0 +1,30 @@
+"""
+Проверка (и при --repair — исправление) агрегатов shift_stats по фактическим task_items.
+
+Запуск: python scripts/check_shift_stats.py [--shift ID] [--repair]
+"""
+
+import argparse
+
+from app.db.init_db import init_db
+from app.services.repositories import TaskRepository
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--shift", type=int, default=None, help="id смены (по умолчанию — все смены)")
+    ap.add_argument("--repair", action="store_true", help="записать пересчитанные значения")
+    args = ap.parse_args()
+
+    init_db()
+    diffs = TaskRepository().check_shift_stats(args.shift, repair=args.repair)
+    for d in diffs:
+        print(f"смена {d['shift_id']} слот {d['slot']}: было {d['stored']}, факт {d['actual']}")
+    if not diffs:
+        print("Расхождений нет.")
+    elif args.repair:
+        print(f"Исправлено слотов: {len(diffs)}")
+    else:
+        print(f"Расхождений: {len(diffs)} (запустите с --repair для исправления)")
+
+if __name__ == "__main__":
+    main()
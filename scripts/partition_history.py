@@ -0,0 +1,27 @@
+"""
+Перевод collector_history / check_history на помесячное партиционирование по occurred_at
+(BRIN-индексы по occurred_at создаются вместе с таблицей). Запускать вне смены.
+
+После миграции включите HISTORY_PARTITIONING=1 в .env, чтобы init_db досоздавал будущие партиции.
+
+Запуск: python scripts/partition_history.py [--batch 50000] [--keep-legacy]
+"""
+
+import argparse
+
+from app.db.database import engine
+from app.db.init_db import init_db
+from app.db.partitioning import PARTITIONED_TABLES, migrate_to_partitioned
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--batch", type=int, default=50000, help="строк за одну транзакцию переноса")
+    ap.add_argument("--keep-legacy", action="store_true", help="не удалять <table>_legacy после переноса")
+    args = ap.parse_args()
+
+    init_db()
+    for table in PARTITIONED_TABLES:
+        migrate_to_partitioned(engine, table, batch_rows=args.batch, keep_legacy=args.keep_legacy)
+
+if __name__ == "__main__":
+    main()
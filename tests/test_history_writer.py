@@ -0,0 +1,34 @@
+import threading
+import time
+import unittest
+
+from app.services.history_writer import CoalescingHistoryWriter
+
+class FakeHistoryRepo:
+    def __init__(self):
+        self.written = []
+        self.flushed = threading.Event()
+
+    def add_collect_many(self, events):
+        self.written.extend(events)
+        self.flushed.set()
+        return len(events)
+
+    add_check_many = add_collect_many
+
+class CoalescingHistoryWriterTest(unittest.TestCase):
+    def test_single_event_flushed_after_max_delay(self):
+        repo = FakeHistoryRepo()
+        w = CoalescingHistoryWriter(repo, max_events=200, max_delay_s=0.1, log=lambda msg: None)
+        try:
+            started = time.monotonic()
+            w.append("collect", {"article": "A", "collector": "c"})
+            self.assertTrue(repo.flushed.wait(1.0))
+            self.assertLess(time.monotonic() - started, 1.0)
+            self.assertEqual(len(repo.written), 1)
+            self.assertEqual(w.pending(), 0)
+        finally:
+            w.close()
+
+if __name__ == "__main__":
+    unittest.main()